@@ -0,0 +1,235 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+"""
+A persistent cache for the listings of large directories.
+
+Each directory is stored in a file of its own, named after the md5 sum of
+its path.  The file is only used if the mtime and inode of the directory
+still match.  The files are evicted in LRU order (by their mtime, which is
+updated on each use) when the cache grows beyond its size limit.
+
+File format (little endian):
+	header: magic, mtime (double), inode (Q), count of all files (I),
+		length of path (H), length of filter key (H), path, filter key
+	body (zlib compressed): one record per file:
+		flags (B), mode (I), inode (Q), length of name (H), name,
+		if flags & HAS_STAT: nlink (I), uid (I), gid (I), size (Q),
+			atime (d), mtime (d), ctime (d)
+
+The inode is 0 if it's unknown.  Symlinks are stored without a stat.
+"""
+
+import os
+import struct
+import sys
+import zlib
+from hashlib import md5
+from os.path import join
+
+MAGIC = b'RLC2'
+HAS_STAT = 1
+IS_DIR = 2     # points to a directory (after following symlinks)
+IS_LINK = 4
+
+# Smaller directories are quick to load and not worth caching
+MIN_FILES = 1000
+
+_header = struct.Struct('<4sdQIHH')
+_record = struct.Struct('<BIQH')
+_stat = struct.Struct('<IIIQddd')
+
+if sys.version_info >= (3, ):
+	_encode = os.fsencode
+	_decode = os.fsdecode
+else:
+	_encode = _decode = lambda name: name
+
+class CachedEntry(object):
+	"""Mimics the parts of os.DirEntry which Directory uses"""
+
+	def __init__(self, path, name, flags, mode, inode, stat):
+		self.path = path
+		self.name = name
+		self._flags = flags
+		self._mode = mode
+		self._inode = inode
+		self._stat = None if flags & IS_LINK else stat
+
+	def is_symlink(self):
+		return bool(self._flags & IS_LINK)
+
+	def is_dir(self, follow_symlinks=True):
+		if self._flags & IS_LINK and not follow_symlinks:
+			return False
+		return bool(self._flags & IS_DIR)
+
+	def is_file(self, follow_symlinks=True):
+		if self._flags & IS_LINK and not follow_symlinks:
+			return False
+		return self._mode & 0o170000 == 0o100000
+
+	def stat(self, follow_symlinks=True):
+		if self._stat is None:
+			if follow_symlinks:
+				return os.stat(self.path)
+			return os.lstat(self.path)
+		return self._stat
+
+	def inode(self):
+		if self._inode:
+			return self._inode
+		return self.stat(follow_symlinks=False).st_ino
+
+	def __repr__(self):
+		return "<CachedEntry {0}>".format(self.name)
+
+
+class ListingCache(object):
+	def __init__(self, path, max_size):
+		self.path = path
+		self.max_size = max_size
+		if not os.path.isdir(path):
+			try:
+				os.makedirs(path)
+			except OSError:
+				pass
+
+	def _filename(self, path):
+		return join(self.path, md5(_encode(path)).hexdigest())
+
+	def get(self, path, filter_key):
+		"""
+		Returns a tuple of the number of all files and a list of
+		CachedEntry objects for the accepted files, or None if there is
+		no valid cache for this directory.
+		"""
+		filename = self._filename(path)
+		try:
+			f = open(filename, 'rb')
+			try:
+				data = f.read()
+			finally:
+				f.close()
+			dir_stat = os.stat(path)
+		except (IOError, OSError):
+			return None
+
+		try:
+			magic, mtime, inode, count, path_len, key_len = \
+					_header.unpack_from(data, 0)
+			offset = _header.size
+			cached_path = _decode(data[offset:offset + path_len])
+			offset += path_len
+			cached_key = _decode(data[offset:offset + key_len])
+			offset += key_len
+			if magic != MAGIC or cached_path != path \
+					or cached_key != filter_key or mtime != dir_stat.st_mtime \
+					or inode != dir_stat.st_ino:
+				return None
+			body = zlib.decompress(data[offset:])
+		except (struct.error, zlib.error):
+			return None
+
+		try:
+			os.utime(filename, None)  # for the LRU eviction
+		except OSError:
+			pass
+
+		entries = []
+		prefix = path == '/' and '/' or path + '/'
+		dev = dir_stat.st_dev
+		offset = 0
+		length = len(body)
+		while offset < length:
+			flags, mode, ino, name_len = _record.unpack_from(body, offset)
+			offset += _record.size
+			name = _decode(body[offset:offset + name_len])
+			offset += name_len
+			if flags & HAS_STAT:
+				nlink, uid, gid, size, atime, mtime, ctime = \
+						_stat.unpack_from(body, offset)
+				offset += _stat.size
+				stat = os.stat_result((mode, ino, dev, nlink, uid, gid,
+					size, atime, mtime, ctime))
+			else:
+				stat = None
+			entries.append(CachedEntry(prefix + name, name, flags, mode,
+					ino, stat))
+		return count, entries
+
+	def store(self, path, filter_key, count, records):
+		"""
+		Returns a generator which stores the listing of a directory.
+		<count> is the number of all files, <records> an iterable of
+		(name, flags, mode, inode, stat) tuples for the files that were
+		accepted by the filter, where inode may be 0 and stat None.
+		"""
+		try:
+			dir_stat = os.stat(path)
+		except OSError:
+			return
+		compressor = zlib.compressobj()
+		chunks = []
+		for i, (name, flags, mode, inode, stat) in enumerate(records):
+			name = _encode(name)
+			if flags & IS_LINK:
+				stat = None  # it would be the stat of the target
+			if stat is not None:
+				flags |= HAS_STAT
+				mode = stat.st_mode
+			else:
+				flags &= ~HAS_STAT
+			record = _record.pack(flags, mode, inode, len(name)) + name
+			if stat is not None:
+				record += _stat.pack(stat.st_nlink, stat.st_uid,
+						stat.st_gid, stat.st_size, stat.st_atime,
+						stat.st_mtime, stat.st_ctime)
+			chunks.append(compressor.compress(record))
+			if i % 1000 == 999:
+				yield
+		chunks.append(compressor.flush())
+
+		encoded_path = _encode(path)
+		encoded_key = _encode(filter_key)
+		header = _header.pack(MAGIC, dir_stat.st_mtime, dir_stat.st_ino,
+				count, len(encoded_path), len(encoded_key))
+		filename = self._filename(path)
+		try:
+			f = open(filename + '.tmp', 'wb')
+			try:
+				f.write(header + encoded_path + encoded_key)
+				f.write(b''.join(chunks))
+			finally:
+				f.close()
+			os.rename(filename + '.tmp', filename)
+		except (IOError, OSError):
+			return
+		yield
+		self.evict()
+
+	def evict(self):
+		"""Delete the least recently used files until the cache fits"""
+		try:
+			names = os.listdir(self.path)
+		except OSError:
+			return
+		files = []
+		total = 0
+		for name in names:
+			filename = join(self.path, name)
+			try:
+				stat = os.stat(filename)
+			except OSError:
+				continue
+			files.append((stat.st_mtime, stat.st_size, filename))
+			total += stat.st_size
+		files.sort()
+		for mtime, size, filename in files:
+			if total <= self.max_size:
+				break
+			try:
+				os.remove(filename)
+			except OSError:
+				pass
+			total -= size
@@ -0,0 +1,60 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+class MarkedItems(object):
+	"""
+	The marked files of a directory, indexed by their paths.
+
+	Adding, removing and looking up an item takes constant time, and items
+	are told apart by their path, so a new object for the same file counts
+	as the same item.  Iterating goes over a copy, so the marks can be
+	changed meanwhile.
+
+	>>> from collections import namedtuple
+	>>> Item = namedtuple('Item', 'path')
+	>>> marked = MarkedItems()
+	>>> marked.add(Item('/a'))
+	>>> marked.add(Item('/b'))
+	>>> marked.add(Item('/a'))
+	>>> len(marked), Item('/a') in marked, '/b' in marked.paths()
+	(2, True, True)
+	>>> marked.discard(Item('/a'))
+	>>> marked.discard(Item('/c'))
+	>>> list(marked)
+	[Item(path='/b')]
+	>>> marked.clear()
+	>>> bool(marked)
+	False
+	"""
+
+	def __init__(self):
+		self._items = {}
+
+	def add(self, item):
+		self._items[item.path] = item
+
+	def discard(self, item):
+		self._items.pop(item.path, None)
+
+	def clear(self):
+		self._items.clear()
+
+	def paths(self):
+		"""Returns a set of the paths of the marked items"""
+		return set(self._items)
+
+	def __contains__(self, item):
+		return item.path in self._items
+
+	def __iter__(self):
+		return iter(list(self._items.values()))
+
+	def __len__(self):
+		return len(self._items)
+
+	def __repr__(self):
+		return "<MarkedItems of {0} files>".format(len(self._items))
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -8,10 +8,14 @@ from ranger.core.shared import FileManagerAware
 ALLOWED_SETTINGS = {
 	'autosave_bookmarks': bool,
 	'autoupdate_cumulative_size': bool,
+	'background_stat_threshold': (int, type(None)),
 	'collapse_preview': bool,
 	'colorscheme_overlay': (type(None), type(lambda:0)),
 	'colorscheme': str,
 	'column_ratios': (tuple, list),
+	'compact_threshold': (int, type(None)),
+	'copy_threads': int,
+	'directory_memory_limit': (int, type(None)),
 	'dirname_in_tabs': bool,
 	'display_size_in_main_column': bool,
 	'display_size_in_status_bar': bool,
@@ -21,7 +25,9 @@ ALLOWED_SETTINGS = {
 	'flushinput': bool,
 	'hidden_filter': lambda x: isinstance(x, str) or hasattr(x, 'match'),
 	'init_function': (type(None), type(lambda:0)),
+	'listing_cache_size': (int, type(None)),
 	'load_default_rc': (bool, type(None)),
+	'loader_threads': int,
 	'max_console_history_size': (int, type(None)),
 	'max_history_size': (int, type(None)),
 	'mouse_enabled': bool,
@@ -39,9 +45,14 @@ ALLOWED_SETTINGS = {
 	'sort_directories_first': bool,
 	'sort_reverse': bool,
 	'sort': str,
+	'stat_threads': dict,
 	'tilde_in_titlebar': bool,
+	'transfer_checksums': bool,
+	'trash_max_age': (int, type(None)),
+	'trash_max_size': (int, type(None)),
 	'update_title': bool,
 	'use_preview_script': bool,
+	'use_trash': bool,
 	'unicode_ellipsis': bool,
 	'xterm_alt_key': bool,
 }
@@ -4,11 +4,10 @@
 import codecs
 import os
 import re
-import shutil
 import string
 import tempfile
-from os.path import join, isdir, realpath, exists
-from os import link, symlink, getcwd, listdir, stat
+from os.path import join, realpath
+from os import link, symlink, getcwd
 from inspect import cleandoc
 
 import ranger
@@ -18,10 +17,12 @@ from ranger.ext.keybinding_parser import key_to_string, construct_keybinding
 from ranger.ext.shell_escape import shell_quote
 from ranger.ext.next_available_filename import next_available_filename
 from ranger.ext.rifle import squash_flags
+from ranger.ext.transfer import Journal
 from ranger.core.shared import FileManagerAware, EnvironmentAware, \
 		SettingsAware
 from ranger.fsobject import File
-from ranger.core.loader import CommandLoader
+from ranger.core.loader import CommandLoader, CopyLoader, DeleteLoader, \
+		LinkLoader, PRIORITY_PREVIEW
 
 MACRO_FAIL = "<\x01\x01MACRO_HAS_NO_VALUE\x01\01>"
 
@@ -110,7 +111,7 @@ class Actions(FileManagerAware, EnvironmentAware, SettingsAware):
 
 	def get_cumulative_size(self):
 		for f in self.env.get_selection() or ():
-			f.look_up_cumulative_size()
+			f.look_up_cumulative_size(fresh=True)
 		self.ui.status.request_redraw()
 		self.ui.redraw_main_column()
 
@@ -191,8 +192,17 @@ class Actions(FileManagerAware, EnvironmentAware, SettingsAware):
 			macros['c'] = MACRO_FAIL
 
 		if self.fm.env.cwd.files:
-			macros['t'] = [fl.basename for fl in self.fm.env.cwd.files
-					if fl.realpath in (self.fm.tags or [])]
+			# Going by the names spares creating the items of a FileList
+			cwd = self.fm.env.cwd
+			tags = self.fm.tags or []
+			links = cwd.get_link_names()
+			macros['t'] = []
+			for name in cwd.get_names():
+				path = join(cwd.path, name)
+				if name in links:
+					path = realpath(path)
+				if path in tags:
+					macros['t'].append(name)
 		else:
 			macros['t'] = MACRO_FAIL
 
@@ -499,10 +509,12 @@ class Actions(FileManagerAware, EnvironmentAware, SettingsAware):
 			self.env.settings['sort'] = str(func)
 
 	def set_filter(self, fltr):
+		"""Show only the files which contain <fltr> in their basename"""
 		try:
 			self.env.cwd.filter = fltr
 		except:
-			pass
+			return
+		self.env.cwd.refilter()
 
 	def mark_files(self, all=False, toggle=False, val=None, movedown=None, narg=1):
 		"""
@@ -581,36 +593,20 @@ class Actions(FileManagerAware, EnvironmentAware, SettingsAware):
 		else:
 			self.set_search_method(order=order)
 
-		if order in ('search', 'tag'):
-			if order == 'search':
-				arg = self.env.last_search
-				if arg is None:
-					return False
-				if hasattr(arg, 'search'):
-					fnc = lambda x: arg.search(x.basename)
-				else:
-					fnc = lambda x: arg in x.basename
-			elif order == 'tag':
-				fnc = lambda x: x.realpath in self.tags
+		if order == 'search':
+			arg = self.env.last_search
+			if arg is None:
+				return False
+			return self.env.cwd.search(arg, offset=offset, forward=forward)
 
+		elif order == 'tag':
+			fnc = lambda x: x.realpath in self.tags
 			return self.env.cwd.search_fnc(fnc=fnc, offset=offset, forward=forward)
 
 		elif order in ('size', 'mimetype', 'ctime', 'mtime', 'atime'):
 			cwd = self.env.cwd
 			if original_order is not None or not cwd.cycle_list:
-				lst = list(cwd.files)
-				if order == 'size':
-					fnc = lambda item: -item.size
-				elif order == 'mimetype':
-					fnc = lambda item: item.mimetype
-				elif order == 'ctime':
-					fnc = lambda item: -int(item.stat and item.stat.st_ctime)
-				elif order == 'atime':
-					fnc = lambda item: -int(item.stat and item.stat.st_atime)
-				elif order == 'mtime':
-					fnc = lambda item: -int(item.stat and item.stat.st_mtime)
-				lst.sort(key=fnc)
-				cwd.set_cycle_list(lst)
+				cwd.set_cycle_list(cwd.get_ordering(order))
 				return cwd.cycle(forward=None)
 
 			return cwd.cycle(forward=forward)
@@ -823,7 +819,9 @@ class Actions(FileManagerAware, EnvironmentAware, SettingsAware):
 						pass
 				loadable.signal_bind('after', on_after)
 				loadable.signal_bind('destroy', on_destroy)
-				self.loader.add(loadable)
+				# Only the preview of the current file is needed
+				self.loader.add(loadable, priority=PRIORITY_PREVIEW,
+						key='preview')
 				return None
 			else:
 				return found
@@ -1014,26 +1012,25 @@ class Actions(FileManagerAware, EnvironmentAware, SettingsAware):
 				self.notify(x)
 
 	def paste_hardlinked_subtree(self):
-		for f in self.env.copy:
-			try:
-				target_path = join(getcwd(), f.basename)
-				self._recurse_hardlinked_tree(f.path, target_path)
-			except Exception as x:
-				self.notify(x)
+		"""
+		Mirror the copied trees into the current directory with hard links.
+		Symlinks are followed, so symlinked directories are mirrored too.
+		"""
+		copied_files = tuple(self.env.copy)
+		if not copied_files:
+			return
+
+		original_path = self.env.cwd.path
+		def refresh(_):
+			self.env.get_directory(original_path).load_content()
 
-	def _recurse_hardlinked_tree(self, source_path, target_path):
-		if isdir(source_path):
-			if not exists(target_path):
-				os.mkdir(target_path, stat(source_path).st_mode)
-			for item in listdir(source_path):
-				self._recurse_hardlinked_tree(
-					join(source_path, item),
-					join(target_path, item))
+		if len(copied_files) == 1:
+			descr = "linking: " + copied_files[0].path
 		else:
-			if not exists(target_path) \
-			or stat(source_path).st_ino != stat(target_path).st_ino:
-				link(source_path,
-					next_available_filename(target_path))
+			descr = "linking files from: " + copied_files[0].dirname
+		obj = LinkLoader([f.path for f in copied_files], original_path, descr)
+		obj.signal_bind('after', refresh)
+		self.loader.add(obj)
 
 	def paste(self, overwrite=False):
 		"""Paste the selected items into the current directory"""
@@ -1049,59 +1046,83 @@ class Actions(FileManagerAware, EnvironmentAware, SettingsAware):
 		cwd = self.env.cwd
 		original_path = cwd.path
 		one_file = copied_files[0]
-		if overwrite:
-			cp_flags = ['-af', '--']
-			mv_flags = ['-f', '--']
-		else:
-			cp_flags = ['--backup=numbered', '-a', '--']
-			mv_flags = ['--backup=numbered', '--']
+		paths = [f.path for f in copied_files]
 
-		if self.env.cut:
+		# Like cp -a and mv with --backup=numbered, or with -f when
+		# overwriting.  Copying a file onto itself (yypp) creates a backup.
+		move = self.env.cut
+		if move:
 			self.env.copy.clear()
 			self.env.cut = False
 			if len(copied_files) == 1:
 				descr = "moving: " + one_file.path
 			else:
 				descr = "moving files from: " + one_file.dirname
-			obj = CommandLoader(args=['mv'] + mv_flags \
-					+ [f.path for f in copied_files] \
-					+ [cwd.path], descr=descr)
 		else:
 			if len(copied_files) == 1:
 				descr = "copying: " + one_file.path
 			else:
 				descr = "copying files from: " + one_file.dirname
-			if not overwrite and len(copied_files) == 1 \
-					and one_file.dirname == cwd.path:
-				# Special case: yypp
-				# copying a file onto itself -> create a backup
-				obj = CommandLoader(args=['cp', '-f'] + cp_flags \
-						+ [one_file.path, one_file.path], descr=descr)
-			else:
-				obj = CommandLoader(args=['cp'] + cp_flags \
-						+ [f.path for f in copied_files] \
-						+ [cwd.path], descr=descr)
 
+		journal = None
+		if not ranger.arg.clean:
+			try:
+				journal = Journal.create(self.confpath('transfers'), paths,
+						cwd.path, move=move, overwrite=overwrite,
+						checksums=self.settings.transfer_checksums,
+						description=descr)
+			except (IOError, OSError) as err:
+				self.notify("Can't keep a journal of the transfer: {0}"
+						.format(err), bad=True)
+
+		obj = CopyLoader(paths, cwd.path, descr, move=move,
+				overwrite=overwrite, journal=journal)
 		obj.signal_bind('after', refresh)
 		self.loader.add(obj)
 
+	def resume_transfers(self):
+		"""Resume the pastes which were interrupted when ranger quit"""
+		if ranger.arg.clean:
+			return
+		for journal in Journal.find(self.confpath('transfers')):
+			def refresh(signal):
+				self.env.get_directory(signal.loader.journal.target_dir) \
+						.load_content()
+			descr = journal.description or "pasting to: " + journal.target_dir
+			self.notify("Resuming " + descr)
+			obj = CopyLoader(journal.paths, journal.target_dir, descr,
+					move=journal.move, overwrite=journal.overwrite,
+					journal=journal)
+			obj.signal_bind('after', refresh)
+			self.loader.add(obj)
+
 	def delete(self):
 		# XXX: warn when deleting mount points/unseen marked files?
-		self.notify("Deleting!")
 		selected = self.env.get_selection()
 		self.env.copy -= set(selected)
-		if selected:
-			for f in selected:
-				if isdir(f.path) and not os.path.islink(f.path):
-					try:
-						shutil.rmtree(f.path)
-					except OSError as err:
-						self.notify(err)
-				else:
-					try:
-						os.remove(f.path)
-					except OSError as err:
-						self.notify(err)
+		if selected and self.settings.use_trash:
+			self.notify("Moving to the trash!")
+			cwd = self.env.cwd
+			for path, error in self.trash.put([f.path for f in selected],
+					cwd.mount_path):
+				self.notify("{0}: {1}".format(path, error), bad=True)
+			cwd.load_content()
+		elif selected:
+			self.notify("Deleting!")
+			cwd = self.env.cwd
+			original_path = cwd.path
+			if len(selected) == 1:
+				descr = "deleting: " + selected[0].path
+			else:
+				descr = "deleting files in: " + selected[0].dirname
+
+			def refresh(_):
+				self.env.get_directory(original_path).load_content()
+
+			obj = DeleteLoader([f.path for f in selected], descr,
+					threads=cwd.get_stat_threads())
+			obj.signal_bind('after', refresh)
+			self.loader.add(obj)
 		self.env.ensure_correct_pointer()
 
 	def mkdir(self, name):
@@ -0,0 +1,141 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+"""
+The EntryCounter counts the entries of subdirectories in the background.
+
+The infostring of a directory which isn't loaded shows its number of
+entries.  Instead of listing each subdirectory when it is drawn, the
+directories are queued here and counted by a task of the loader.  The
+counts are remembered along with the mtime of the directory.
+"""
+
+import os
+from collections import deque
+from time import time
+from ranger.core.shared import FileManagerAware
+from ranger.core.loader import Loadable
+
+class EntryCountLoader(Loadable):
+	"""
+	Counts the entries of the pending directories on a thread of the
+	loader.  Only the numbers are collected there, finish() applies them
+	to the directories on the main thread.
+	"""
+	threaded = True
+
+	# Stop after this many seconds, so the counts appear while many
+	# directories are counted.  The EntryCounter starts the next batch.
+	batch_time = 0.2
+
+	def __init__(self, counter):
+		Loadable.__init__(self, None, "Counting the entries of directories")
+		self.counter = counter
+		self.results = []  # (directory, number of entries or None)
+		self.load_generator = self._generate()
+
+	def _generate(self):
+		pending = self.counter.pending
+		start = time()
+		while time() - start < self.batch_time:
+			try:
+				directory = pending.popleft()
+			except IndexError:
+				return
+			try:
+				count = len(os.listdir(directory.path))
+			except OSError:
+				count = None
+			self.results.append((directory, count))
+			yield
+
+	def cancel(self):
+		self.counter._cancelled(self)
+
+	def finish(self):
+		self.counter._apply(self)
+
+
+class EntryCounter(FileManagerAware):
+	# Only the most recently requested directories are counted, the
+	# others are probably not visible anymore.
+	max_pending = 256
+
+	# Forget all counts when remembering more directories than this
+	max_cached = 100000
+
+	def __init__(self):
+		self.counts = {}  # path -> (mtime, number of entries)
+		self.pending = deque()
+		self.loadable = None
+
+	def get(self, directory):
+		"""Returns the remembered count of the directory or None"""
+		try:
+			mtime = directory.stat.st_mtime
+		except AttributeError:
+			return None
+		try:
+			cached_mtime, count = self.counts[directory.path]
+		except KeyError:
+			return None
+		if cached_mtime != mtime:
+			return None
+		return count
+
+	def remember(self, directory, count):
+		try:
+			mtime = directory.stat.st_mtime
+		except AttributeError:
+			return
+		if len(self.counts) >= self.max_cached:
+			self.counts.clear()
+		self.counts[directory.path] = (mtime, count)
+
+	def count(self, directory):
+		"""
+		Returns the number of entries of the directory, or None if it
+		can't be listed
+		"""
+		count = self.get(directory)
+		if count is None:
+			try:
+				count = len(os.listdir(directory.path))
+			except OSError:
+				return None
+			self.remember(directory, count)
+		return count
+
+	def request(self, directory):
+		"""Count the entries of the directory in the background"""
+		if len(self.pending) >= self.max_pending:
+			self.pending.popleft().forget_entry_count_request()
+		self.pending.append(directory)
+		if self.loadable is None:
+			self.loadable = EntryCountLoader(self)
+			self.fm.loader.add(self.loadable, append=True)
+
+	def _apply(self, loadable):
+		"""Set the counts of a finished EntryCountLoader"""
+		if self.loadable is loadable:
+			self.loadable = None
+		for directory, count in loadable.results:
+			if count is not None:
+				self.remember(directory, count)
+			directory.load_entry_count()
+		try:
+			self.fm.ui.browser.need_redraw = True
+		except AttributeError:
+			pass
+		if self.pending and self.loadable is None:
+			self.loadable = EntryCountLoader(self)
+			self.fm.loader.add(self.loadable, append=True)
+
+	def _cancelled(self, loadable):
+		"""Forget the requests of an EntryCountLoader which was removed"""
+		if self.loadable is loadable:
+			self.loadable = None
+		for directory, count in loadable.results:
+			directory.forget_entry_count_request()
+		while self.pending:
+			self.pending.popleft().forget_entry_count_request()
@@ -104,7 +104,7 @@ class Environment(SettingsAware, SignalDispatcher):
 			except KeyError:
 				return directory
 
-	def garbage_collect(self, age, tabs):
+	def garbage_collect(self, age, tabs, previews=None):
 		"""Delete unused directory objects"""
 		for key in tuple(self.directories):
 			value = self.directories[key]
@@ -116,9 +116,59 @@ class Environment(SettingsAware, SignalDispatcher):
 			del self.directories[key]
 			if value.is_directory:
 				value.files = None
+		if age != -1 and self.settings.directory_memory_limit is not None:
+			self.unload_least_recently_used(tabs, previews or {})
 		self.settings.signal_garbage_collect()
 		self.signal_garbage_collect()
 
+	def unload_least_recently_used(self, tabs, previews, loaded=None):
+		"""
+		Unload the contents of the least recently used directories until
+		their estimated memory usage is below directory_memory_limit.
+		The directory objects stay, so they can load their files again.
+		The directory <loaded>, which was just loaded, is kept.
+		"""
+		preview_usage = {}
+		for path, data in previews.items():
+			size = 0
+			for value in data.values():
+				try:
+					size += len(value)
+				except TypeError:
+					pass
+			dirname = os.path.dirname(path)
+			preview_usage[dirname] = preview_usage.get(dirname, 0) + size
+
+		keep = set(directory.path for directory in self.pathway)
+		keep.update(tabs.values())
+		if self.cf is not None and self.cf.is_directory:
+			keep.add(self.cf.path)
+		if loaded is not None:
+			keep.add(loaded.path)
+
+		usage = {}
+		total = 0
+		for directory in self.directories.values():
+			if directory.files is None:
+				continue
+			usage[directory] = directory.memory_usage() + \
+					preview_usage.get(directory.path, 0)
+			total += usage[directory]
+
+		limit = self.settings.directory_memory_limit
+		for directory in sorted(usage, key=lambda d: d.last_used):
+			if total <= limit:
+				break
+			if directory.path in keep or directory.marked_items \
+					or directory.loading \
+					or directory.background_stat is not None:
+				continue
+			total -= usage[directory]
+			directory.unload_content()
+			for path in tuple(previews):
+				if os.path.dirname(path) == directory.path:
+					del previews[path]
+
 	def get_selection(self):
 		if self.cwd:
 			return self.cwd.get_selection()
@@ -180,6 +230,7 @@ class Environment(SettingsAware, SignalDispatcher):
 		self.cwd = new_cwd
 
 		self.cwd.load_content_if_outdated()
+		self.cwd.stat_remaining_files()
 
 		# build the pathway, a tuple of directory objects which lie
 		# on the path to the current directory.
@@ -9,12 +9,14 @@ from time import time
 from collections import deque
 import mimetypes
 import os
+import select
 import stat
 import sys
 
 import ranger
 from ranger.core.actions import Actions
 from ranger.container.tags import Tags
+from ranger.container.listingcache import ListingCache
 from ranger.gui.ui import UI
 from ranger.container.bookmarks import Bookmarks
 from ranger.core.runner import Runner
@@ -24,10 +26,17 @@ from ranger.fsobject import Directory
 from ranger.ext.signals import SignalDispatcher
 from ranger import __version__
 from ranger.core.loader import Loader
+from ranger.core.watcher import DirectoryWatcher
+from ranger.core.counter import EntryCounter
+from ranger.core.trash import Trash
 
 class FM(Actions, SignalDispatcher):
 	input_blocked = False
 	input_blocked_until = 0
+	watcher = None
+	listing_cache = None
+	entry_counter = None
+	trash = None
 	def __init__(self, ui=None, bookmarks=None, tags=None):
 		"""Initialize FM."""
 		Actions.__init__(self)
@@ -87,10 +96,26 @@ class FM(Actions, SignalDispatcher):
 		self.run = Runner(ui=self.ui, logfunc=mylogfunc, fm=self)
 
 		self.env.signal_bind('cd', self._update_current_tab)
+		self.signal_bind('finished_loading_dir', self._check_memory_limit)
+
+		self.watcher = DirectoryWatcher()
+		self.entry_counter = EntryCounter()
+		self.trash = Trash()
+
+		if not ranger.arg.clean:
+			self.listing_cache = ListingCache(self.confpath('listing_cache'),
+					self.settings.listing_cache_size)
+			self.resume_transfers()
 
 		if self.settings.init_function:
 			self.settings.init_function(self)
 
+	def _check_memory_limit(self, signal):
+		"""Keep the loaded directories within directory_memory_limit"""
+		if self.settings.directory_memory_limit is not None:
+			self.env.unload_least_recently_used(self.tabs, self.previews,
+					loaded=signal.directory)
+
 	def destroy(self):
 		debug = ranger.arg.debug
 		if self.ui:
@@ -105,6 +130,12 @@ class FM(Actions, SignalDispatcher):
 			except:
 				if debug:
 					raise
+		if self.watcher:
+			try:
+				self.watcher.destroy()
+			except:
+				if debug:
+					raise
 
 	def block_input(self, sec=0):
 		self.input_blocked = sec != 0
@@ -161,9 +192,10 @@ class FM(Actions, SignalDispatcher):
 		The main loop consists of:
 		1. reloading bookmarks if outdated
 		2. letting the loader work
-		3. drawing and finalizing ui
-		4. reading and handling user input
-		5. after X loops: collecting unused directory objects
+		3. checking for changes in watched directories
+		4. drawing and finalizing ui
+		5. reading and handling user input
+		6. after X loops: collecting unused directory objects
 		"""
 
 		self.env.enter_dir(self.env.path)
@@ -174,24 +206,48 @@ class FM(Actions, SignalDispatcher):
 		ui = self.ui
 		throbber = ui.throbber
 		loader = self.loader
+		watcher = self.watcher
 		env = self.env
 		has_throbber = hasattr(ui, 'throbber')
 		zombies = self.run.zombies
+		stdin = sys.stdin.fileno()
+		wait_fds = [stdin]
+		if watcher and watcher.fileno() is not None:
+			wait_fds.append(watcher.fileno())
+		frame_time = 0
+		got_input = False
 
 		try:
 			while True:
+				if loader.has_work():
+					loader.adapt(frame_time, got_input
+							or select.select([stdin], [], [], 0)[0])
 				loader.work()
+				frame_start = time()
 				if has_throbber:
 					if loader.has_work():
 						throbber(loader.status)
 					else:
 						throbber(remove=True)
 
+				if watcher:
+					watcher.handle_events()
+
 				ui.redraw()
 
-				ui.set_load_mode(not loader.paused and loader.has_work())
+				working = not loader.paused and loader.has_work()
+				frame_time = time() - frame_start
+				if working and not loader.is_busy():
+					# The tasks only wait for processes or threads, so
+					# sleep until they, the user or the watched
+					# directories have something to do
+					loader.wait(2, wait_fds)
+				ui.set_load_mode(working)
 
-				ui.handle_input()
+				input_start = time()
+				got_input = ui.handle_input()
+				if working:
+					frame_time += time() - input_start
 
 				if zombies:
 					for zombie in tuple(zombies):
@@ -202,7 +258,8 @@ class FM(Actions, SignalDispatcher):
 				if gc_tick > ranger.TICKS_BEFORE_COLLECTING_GARBAGE:
 					gc_tick = 0
 					env.garbage_collect(
-						ranger.TIME_BEFORE_FILE_BECOMES_GARBAGE, self.tabs)
+						ranger.TIME_BEFORE_FILE_BECOMES_GARBAGE, self.tabs,
+						self.previews)
 
 		except KeyboardInterrupt:
 			# this only happens in --debug mode. By default, interrupts
@@ -1,22 +1,55 @@
 # Copyright (C) 2009, 2010, 2011  Roman Zimbelmann <romanz@lavabit.com>
 # This software is distributed under the terms of the GNU GPL version 3.
 
-from collections import deque
+from bisect import bisect
 from time import time, sleep
 from subprocess import Popen, PIPE
+from threading import Lock, Thread
+try:
+	from queue import Queue, Empty
+except ImportError:
+	from Queue import Queue, Empty
 from ranger.core.shared import FileManagerAware
 from ranger.ext.signals import SignalDispatcher
+from ranger.ext.human_readable import human_readable
+from ranger.ext.reactor import Reactor
+from ranger.ext.transfer import Transfer, Removal, LinkTree
+import codecs
 import os
 import sys
-import select
 try:
 	import chardet
 	HAVE_CHARDET = True
 except:
 	HAVE_CHARDET = False
 
+PY3 = sys.version >= '3'
+
+# The priorities of tasks.  Tasks with lower numbers get more time.
+PRIORITY_DIRECTORY = 0  # loading a visible directory
+PRIORITY_PREVIEW = 1
+PRIORITY_PREFETCH = 2  # getting information which isn't needed right now
+PRIORITY_BULK = 3  # long file operations
+
 class Loadable(object):
 	paused = False
+	priority = PRIORITY_PREFETCH
+
+	# If true, the load_generator runs on a thread of the loader, so a
+	# blocking system call doesn't block the user interface.  Such
+	# generators must not modify what the main thread may be iterating
+	# over, like the lists of files.  Results can also be applied in
+	# finish(), which is called on the main thread.
+	threaded = False
+
+	# True while the load_generator has nothing to do until the reactor
+	# of the loader receives data for it, or until the wake_time
+	waiting = False
+
+	# The time() at which a waiting load_generator wants to run again
+	# even without data, or None
+	wake_time = None
+
 	def __init__(self, gen, descr):
 		self.load_generator = gen
 		self.description = descr
@@ -36,6 +69,12 @@ class Loadable(object):
 	def destroy(self):
 		pass
 
+	def cancel(self):
+		"""Called when the object is removed before it's finished"""
+
+	def finish(self):
+		"""Called by the loader once the load_generator is exhausted"""
+
 
 class CommandLoader(Loadable, SignalDispatcher, FileManagerAware):
 	"""
@@ -44,9 +83,18 @@ class CommandLoader(Loadable, SignalDispatcher, FileManagerAware):
 	Output from stderr will be reported.  Ensure that the process doesn't
 	ever ask for input, otherwise the loader will be blocked until this
 	object is removed from the queue (type ^C in ranger)
+
+	The output is read by the reactor of the loader, which waits for all
+	running commands at once, so the load_generator only runs when there
+	is something to do.
 	"""
 	finished = False
 	process = None
+	priority = PRIORITY_BULK
+
+	# How often to check whether a process with closed output has exited
+	seconds_of_exit_polling = 0.05
+
 	def __init__(self, args, descr, silent=False, read=False):
 		SignalDispatcher.__init__(self)
 		Loadable.__init__(self, self.generate(), descr)
@@ -54,57 +102,94 @@ class CommandLoader(Loadable, SignalDispatcher, FileManagerAware):
 		self.silent = silent
 		self.read = read
 		self.stdout_buffer = ""
+		self._streams = {}  # fd -> open pipe from the process
+		self._stdout = bytearray()
+		self._stdout_parts = []
+		if PY3:
+			self._stdout_decoder = codecs.getincrementaldecoder('utf-8')()
+		else:
+			self._stdout_decoder = None
+		self._stderr = bytearray()
+
+	@property
+	def waiting(self):
+		if self._streams:
+			return True
+		return self.wake_time is not None and time() < self.wake_time
 
 	def generate(self):
 		null = open(os.devnull, 'r')
 		self.process = process = Popen(self.args,
 				stdout=PIPE, stderr=PIPE, stdin=null)
 		self.signal_emit('before', process=process, loader=self)
-		if self.silent and not self.read:
-			while process.poll() is None:
+		reactor = self.fm.loader.reactor
+		for stream, handler in ((process.stdout, self._on_stdout),
+				(process.stderr, self._on_stderr)):
+			self._streams[stream.fileno()] = stream
+			reactor.register(stream.fileno(), handler)
+		try:
+			while self._streams:
 				yield
-				sleep(0.03)
-		else:
-			py3 = sys.version >= '3'
-			selectlist = []
-			if self.read:
-				selectlist.append(process.stdout)
-			if not self.silent:
-				selectlist.append(process.stderr)
+			# The output is closed, but the process may still run
 			while process.poll() is None:
+				self.wake_time = time() + self.seconds_of_exit_polling
 				yield
-				try:
-					rd, _, __ = select.select(selectlist, [], [], 0.03)
-					if rd:
-						rd = rd[0]
-						if rd == process.stderr:
-							read = rd.readline()
-							if py3:
-								read = safeDecode(read)
-							if read:
-								self.fm.notify(read, bad=True)
-						elif rd == process.stdout:
-							read = rd.read(512)
-							if py3:
-								read = safeDecode(read)
-							if read:
-								self.stdout_buffer += read
-				except select.error:
-					sleep(0.03)
-			if not self.silent:
-				for l in process.stderr.readlines():
-					if py3:
-						l = safeDecode(l)
-					self.fm.notify(l, bad=True)
-			if self.read:
-				read = process.stdout.read()
-				if py3:
-					read = safeDecode(read)
-				self.stdout_buffer += read
+			self.wake_time = None
+		finally:
+			self._close_streams()
+		if self._stderr and not self.silent:
+			self.fm.notify(self._decode(self._stderr), bad=True)
+		if self.read:
+			if self._stdout_decoder is None:
+				self.stdout_buffer = self._decode(self._stdout)
+			else:
+				self._stdout_parts.append(
+						self._stdout_decoder.decode(b'', True))
+				self.stdout_buffer = ''.join(self._stdout_parts)
 		null.close()
 		self.finished = True
 		self.signal_emit('after', process=process, loader=self)
 
+	def _on_stdout(self, data):
+		if not data:
+			self._close_stream(self.process.stdout)
+		elif self.read:
+			self._stdout.extend(data)
+			if self._stdout_decoder is not None:
+				try:
+					self._stdout_parts.append(
+							self._stdout_decoder.decode(data))
+				except UnicodeDecodeError:
+					self._stdout_decoder = None
+
+	def _on_stderr(self, data):
+		if not data:
+			self._close_stream(self.process.stderr)
+		elif not self.silent:
+			self._stderr.extend(data)
+			end = self._stderr.rfind(b'\n')
+			if end != -1:
+				lines = self._stderr[:end].split(b'\n')
+				del self._stderr[:end + 1]
+				for line in lines:
+					if line:
+						self.fm.notify(self._decode(line), bad=True)
+
+	def _decode(self, data):
+		if PY3:
+			return safeDecode(bytes(data))
+		return str(data)
+
+	def _close_stream(self, stream):
+		fd = stream.fileno()
+		if self._streams.pop(fd, None) is not None:
+			self.fm.loader.reactor.unregister(fd)
+			stream.close()
+
+	def _close_streams(self):
+		for stream in list(self._streams.values()):
+			self._close_stream(stream)
+
 	def pause(self):
 		if not self.finished and not self.paused:
 			try:
@@ -127,6 +212,126 @@ class CommandLoader(Loadable, SignalDispatcher, FileManagerAware):
 		self.signal_emit('destroy', process=self.process, loader=self)
 		if self.process:
 			self.process.kill()
+		self._close_streams()
+
+
+class FileOperationLoader(Loadable, SignalDispatcher, FileManagerAware):
+	"""
+	Run an operation of ranger.ext.transfer, like a Transfer or Removal.
+
+	The number of files done is shown in the description.  Errors are
+	reported when the operation is done.
+	"""
+	priority = PRIORITY_BULK
+	threaded = True
+	max_reported_errors = 5
+
+	def __init__(self, operation, descr):
+		SignalDispatcher.__init__(self)
+		Loadable.__init__(self, self.generate(), descr)
+		self.operation = operation
+		self.start_time = None
+
+	def generate(self):
+		self.start_time = time()
+		for _ in self.operation.generate():
+			yield
+
+	def get_description(self):
+		operation = self.operation
+		if not operation.planned:
+			return "{0} (found {1} files)".format(
+					self.description, operation.total_files)
+		return "{0} ({1} of {2} files)".format(self.description,
+				operation.done_files, operation.total_files)
+
+	def finish(self):
+		_report_errors(self.fm, self.operation.errors,
+				self.max_reported_errors)
+		self.signal_emit('after', loader=self)
+
+
+class CopyLoader(FileOperationLoader):
+	"""
+	Copy or move files into a directory.  The progress, rate and
+	remaining time are shown in the description.
+
+	With a ranger.ext.transfer.Journal, the transfer can be resumed after
+	ranger quit.  The journal is removed when the transfer is finished or
+	cancelled.  Since the transfer writes to the journal on a thread, the
+	journal is closed there too, once the transfer stopped.  When ranger
+	quits, the journal stays open until the process exits.
+	"""
+	def __init__(self, paths, target_dir, descr, move=False,
+			overwrite=False, journal=None):
+		FileOperationLoader.__init__(self, Transfer(paths, target_dir,
+				move=move, overwrite=overwrite, journal=journal,
+				threads=self.fm.settings.copy_threads), descr)
+		self.journal = journal
+		self._started = False
+		self._cancelled = False
+		self._lock = Lock()  # for _started and _cancelled
+
+	def generate(self):
+		with self._lock:
+			if self._cancelled:
+				return
+			self._started = True
+		remove = False
+		try:
+			for _ in FileOperationLoader.generate(self):
+				yield
+			remove = True
+		finally:
+			if self.journal is not None:
+				self.journal.close(remove=remove or self._cancelled)
+
+	def cancel(self):
+		with self._lock:
+			self._cancelled = True
+			started = self._started
+		# Otherwise the generator closes it once it stops
+		if not started and self.journal is not None:
+			self.journal.close(remove=True)
+
+	def get_description(self):
+		transfer = self.operation
+		if not transfer.planned:
+			return FileOperationLoader.get_description(self)
+		done, total = transfer.done_bytes, transfer.total_bytes
+		info = ["{0}%".format(100 * done // total if total else 100),
+				"{0} of {1}".format(human_readable(done, separator=''),
+					human_readable(total, separator=''))]
+		elapsed = time() - self.start_time
+		if done and elapsed > 0:
+			rate = done / elapsed
+			seconds = int((total - done) / rate)
+			info.append(human_readable(rate, separator='') + "/s")
+			info.append("{0}:{1:02}:{2:02} left".format(seconds // 3600,
+					seconds // 60 % 60, seconds % 60))
+		return "{0} ({1})".format(self.description, ", ".join(info))
+
+
+class DeleteLoader(FileOperationLoader):
+	"""Delete files and directory trees"""
+	def __init__(self, paths, descr, threads=1):
+		FileOperationLoader.__init__(self, Removal(paths, threads=threads),
+				descr)
+
+
+class LinkLoader(FileOperationLoader):
+	"""Mirror trees of files into a directory with hard links"""
+	def __init__(self, paths, target_dir, descr):
+		FileOperationLoader.__init__(self, LinkTree(paths, target_dir),
+				descr)
+
+
+def _report_errors(fm, errors, limit):
+	for path, error in errors[:limit]:
+		fm.notify("{0}: {1}".format(path, error), bad=True)
+	if len(errors) > limit:
+		fm.notify("...and {0} more errors".format(len(errors) - limit),
+				bad=True)
 
 
 def safeDecode(string):
@@ -145,13 +350,45 @@ class Loader(FileManagerAware):
 	throbber_paused = '#'
 	paused = False
 
+	# How often the threads check whether the loader is still paused
+	seconds_of_pause_polling = 0.05
+
+	# How often the threads wake up the main loop while their tasks make
+	# progress, so it's displayed
+	seconds_of_progress = 0.2
+
+	# In each round, a task runs for its weight times this long before the
+	# next one gets its turn.  The weights are indexed by priority.
+	seconds_of_quantum = 0.001
+	priority_weights = (8, 4, 2, 1)
+
+	# The time budget of work() adapts to the user, see adapt().  While
+	# the user types, a loop through ranger should take no longer than
+	# seconds_of_latency.  After seconds_until_idle without key presses,
+	# the budget grows by budget_growth per loop.
+	min_seconds_of_work_time = 0.005
+	max_seconds_of_work_time = 0.25
+	seconds_of_latency = 0.05
+	seconds_until_idle = 1.0
+	budget_growth = 1.5
+	budget_reason = 'default'
+	last_input_time = 0
+
 	def __init__(self):
-		self.queue = deque()
+		self.queue = []
 		self.item = None
 		self.load_generator = None
 		self.throbber_status = 0
 		self.rotate()
 		self.old_item = None
+		self._tasks = {}  # key -> item
+		self._order = {}  # item -> (key, (priority, sequence))
+		self._sequence = 0
+		self._threads = []
+		self._running = set()  # threaded items which were handed to a thread
+		self._submitted = Queue()
+		self._completed = Queue()
+		self.reactor = Reactor()
 
 	def rotate(self):
 		"""Rotate the throbber"""
@@ -160,52 +397,92 @@ class Loader(FileManagerAware):
 			(self.throbber_status + 1) % len(self.throbber_chars)
 		self.status = self.throbber_chars[self.throbber_status]
 
-	def add(self, obj):
+	def add(self, obj, append=False, priority=None, key=None):
 		"""
 		Add an object to the queue.
 		It should have a load_generator method.
+
+		Objects with a lower priority number are worked on more.  The
+		priority defaults to obj.priority.  Among objects of the same
+		priority, obj is put first, or last if append is True.
+
+		An object in the queue with the same key is superseded: it is
+		removed and destroyed.  The key defaults to the object itself, so
+		adding an object again only moves it.
 		"""
-		while obj in self.queue:
-			self.queue.remove(obj)
-		self.queue.appendleft(obj)
+		if key is None:
+			key = obj
+		old = self._tasks.get(key)
+		if old is not None:
+			# Compared by identity, since distinct directories with the same
+			# path are equal.  The old one needs to be unloaded.
+			if old is obj:
+				self._discard(old)
+			else:
+				self.remove(old)
+		if priority is None:
+			priority = obj.priority
+		self._insert(obj, key, priority, append)
 		if self.paused:
 			obj.pause()
 		else:
 			obj.unpause()
 
+	def _insert(self, item, key, priority, append):
+		self._sequence += 1
+		sort_key = (priority, self._sequence if append else -self._sequence)
+		index = bisect([self._order[test][1] for test in self.queue], sort_key)
+		self.queue.insert(index, item)
+		self._tasks[key] = item
+		self._order[item] = (key, sort_key)
+
+	def _discard(self, item):
+		"""Take the item out of the queue"""
+		key, sort_key = self._order.pop(item)
+		if self._tasks.get(key) is item:
+			del self._tasks[key]
+		for i, test in enumerate(self.queue):
+			if test is item:
+				del self.queue[i]
+				break
+
 	def move(self, _from, to):
 		try:
 			item = self.queue[_from]
 		except IndexError:
 			return
 
-		del self.queue[_from]
+		key = self._order[item][0]
+		self._discard(item)
 
 		if to == 0:
-			self.queue.appendleft(item)
-			if _from != 0:
-				self.queue[1].pause()
+			priority = self.queue and self._order[self.queue[0]][1][0] or 0
+			self._insert(item, key, priority, append=False)
 		elif to == -1:
-			self.queue.append(item)
+			priority = self.queue and self._order[self.queue[-1]][1][0] or 0
+			self._insert(item, key, priority, append=True)
 		else:
 			raise NotImplementedError
 
 	def remove(self, item=None, index=None):
 		if item is not None and index is None:
 			for i, test in enumerate(self.queue):
-				if test == item:
-					index = i 
+				if test is item:
+					index = i
 					break
 			else:
 				return
 
 		if index is not None:
-			if item is None:
-				item = self.queue[index]
+			item = self.queue[index]
 			if hasattr(item, 'unload'):
 				item.unload()
+			if item in self._running:
+				# Tell the thread to stop
+				item.load_generator = None
+			item.cancel()
 			item.destroy()
-			del self.queue[index]
+			self._discard(item)
 
 	def pause(self, state):
 		"""
@@ -218,58 +495,210 @@ class Loader(FileManagerAware):
 
 		self.paused = state
 
-		if not self.queue:
-			return
+		for item in self.queue:
+			if state:
+				item.pause()
+			else:
+				item.unpause()
 
-		if state:
-			self.queue[0].pause()
+	def adapt(self, frame_time, got_input):
+		"""
+		Choose the time budget for the next call of work().
+
+		<frame_time> is how long ranger needed for the rest of the last
+		loop, like drawing and handling keys, and <got_input> tells
+		whether keys were pressed or are waiting to be handled.
+		"""
+		now = time()
+		if got_input:
+			self.last_input_time = now
+			budget = self.min_seconds_of_work_time
+			reason = 'input'
+		elif now - self.last_input_time < self.seconds_until_idle:
+			budget = self.seconds_of_latency - frame_time
+			reason = 'typing'
 		else:
-			self.queue[0].unpause()
+			budget = self.seconds_of_work_time * self.budget_growth
+			reason = 'idle'
+		self.seconds_of_work_time = min(self.max_seconds_of_work_time,
+				max(self.min_seconds_of_work_time, budget))
+		self.budget_reason = reason
+
+	def get_budget_stat(self):
+		"""Describes the current time budget, for debugging"""
+		return "{0:.0f}ms per loop ({1})".format(
+				self.seconds_of_work_time * 1000, self.budget_reason)
 
 	def work(self):
 		"""
 		Load items from the queue if there are any.
 		Stop after approximately self.seconds_of_work_time.
+
+		The items take turns, so several of them make progress at once.
+		In each round, an item runs for a time depending on its priority.
+		A round that isn't complete when the time is up continues in the
+		next call.
 		"""
+		self.reactor.poll(0)
+		self._collect()
+
 		if self.paused:
 			self.status = self.throbber_paused
 			return
 
-		while True:
-			# get the first item with a proper load_generator
-			try:
-				item = self.queue[0]
-				if item.load_generator is None:
-					self.queue.popleft()
-				else:
-					break
-			except IndexError:
-				return
-
-		item.unpause()
+		for item in list(self.queue):
+			if item.load_generator is None and item not in self._running:
+				self._discard(item)
+		if not self.queue:
+			return
 
 		self.rotate()
-		if item != self.old_item:
-			if self.old_item:
-				self.old_item.pause()
-			self.old_item = item
-		item.unpause()
 
+		# Threaded items run alongside the others
+		items = []
+		threads = self._get_threads()
+		for item in self.queue:
+			if item in self._running or item.waiting:
+				continue
+			if item.threaded and threads:
+				self._submit(item, threads)
+			else:
+				items.append(item)
+		if not items:
+			return
+
+		try:
+			i = items.index(self.old_item) + 1
+		except ValueError:
+			i = 0
 		end_time = time() + self.seconds_of_work_time
+		weights = self.priority_weights
+		while items and time() < end_time:
+			if i >= len(items):
+				i = 0
+			item = items[i]
+			priority = min(max(0, self._order[item][1][0]), len(weights) - 1)
+			quantum = weights[priority] * self.seconds_of_quantum
+			if self._run(item, min(end_time, time() + quantum)):
+				self.old_item = item
+				i += 1
+			else:
+				del items[i]
 
+	def _run(self, item, end_time):
+		"""Work on the item until end_time, returns False if it's done"""
 		try:
-			while time() < end_time:
+			next(item.load_generator)
+			while time() < end_time and not item.waiting:
 				next(item.load_generator)
 		except StopIteration:
 			item.load_generator = None
-			self.queue.remove(item)
+			self._discard(item)
+			item.finish()
+			return False
 		except Exception as err:
+			item.load_generator = None
+			self._discard(item)
 			self.fm.notify(err)
+			return False
+		return True
+
+	def _get_threads(self):
+		try:
+			return self.fm.settings.loader_threads
+		except AttributeError:
+			return 0
+
+	def _submit(self, item, threads):
+		"""Hand the threaded item to a thread"""
+		while len(self._threads) < threads:
+			thread = Thread(target=self._run_thread)
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+		item.unpause()
+		self._running.add(item)
+		self._submitted.put(item)
+
+	def _run_thread(self):
+		while True:
+			item = self._submitted.get()
+			if item is None:
+				return
+			generator = item.load_generator
+			error = None
+			next_wakeup = time() + self.seconds_of_progress
+			try:
+				for _ in generator:
+					while self.paused and item.load_generator is generator:
+						sleep(self.seconds_of_pause_polling)
+					if item.load_generator is not generator:
+						# Removed, so clean up on this thread
+						generator.close()
+						break
+					if time() >= next_wakeup:
+						next_wakeup = time() + self.seconds_of_progress
+						self.reactor.wakeup()
+			except Exception as err:
+				error = err
+			self._completed.put((item, generator, error))
+			self.reactor.wakeup()
+
+	def _collect(self):
+		"""Take care of the items which the threads are done with"""
+		while True:
+			try:
+				item, generator, error = self._completed.get_nowait()
+			except Empty:
+				return
+			self._running.discard(item)
+			if item.load_generator is not generator:
+				continue  # it was removed meanwhile
+			item.load_generator = None
+			if item in self._order:
+				self._discard(item)
+			if error is None:
+				item.finish()
+			else:
+				self.fm.notify(error)
 
 	def has_work(self):
 		"""Is there anything to load?"""
 		return bool(self.queue)
 
+	def is_busy(self):
+		"""
+		Is there anything to load right now, besides waiting for the
+		reactor and the threads?
+		"""
+		if self.paused:
+			return False
+		if not self._completed.empty():
+			return True
+		for item in self.queue:
+			if item.load_generator is not None and not item.waiting \
+					and item not in self._running:
+				return True
+		return False
+
+	def wait(self, timeout, fds=()):
+		"""
+		Sleep until there is news for a task or one of the <fds> is
+		readable, but at most <timeout> seconds and not past the wake_time
+		of a task.
+		"""
+		now = time()
+		for item in self.queue:
+			if item.wake_time is not None:
+				timeout = min(timeout, max(0, item.wake_time - now))
+		self.reactor.poll(timeout, fds)
+
 	def destroy(self):
 		while self.queue:
-			self.queue.pop().destroy()
+			item = self.queue.pop()
+			if item in self._running:
+				item.load_generator = None
+			item.destroy()
+		for thread in self._threads:
+			self._submitted.put(None)
+		self.reactor.destroy()
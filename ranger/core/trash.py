@@ -0,0 +1,307 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+"""
+The Trash moves deleted files into a trash directory.
+
+The trash directory is on the same file system as the files, so moving
+them there is one rename, no matter how big they are.  The layout follows
+the freedesktop.org trash specification, so other programs can restore the
+files: the trash of the file system with the home directory is in
+~/.local/share/Trash, elsewhere it is .Trash-<uid> at the mount point.
+
+Old files are deleted later by a task of the loader, according to the
+trash_max_age and trash_max_size settings.  Only the files which ranger
+moved into the trash are deleted, never the ones of other programs.  Their
+names are remembered in the file "trashed" in the configuration directory,
+one JSON list of the trash directory and the name per line.
+"""
+
+import json
+import os
+import threading
+import time
+from errno import EEXIST
+from os.path import basename, expanduser, isdir, join, lexists
+try:
+	from urllib.parse import quote
+except ImportError:
+	from urllib import quote
+
+import ranger
+from ranger.core.shared import FileManagerAware
+from ranger.core.loader import Loadable, PRIORITY_BULK
+from ranger.ext.mount_path import mount_path
+from ranger.ext.transfer import Removal
+from ranger.ext.tree_size import TreeSize
+
+INFO_SUFFIX = '.trashinfo'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+class Trash(FileManagerAware):
+	def __init__(self):
+		self.loadable = None
+		self.purge_requested = False
+		self.tree_size = TreeSize()
+		self._created = None  # trash directory -> names of ranger's files
+		self._lock = threading.Lock()  # for _created and its file
+
+	def directory_for(self, mount):
+		"""Returns the trash directory for files on the mount point"""
+		data_home = os.environ.get('XDG_DATA_HOME') \
+				or join(expanduser('~'), '.local', 'share')
+		if mount_path(data_home) == mount:
+			return join(data_home, 'Trash')
+		return join(mount, '.Trash-{0}'.format(os.getuid()))
+
+	def put(self, paths, mount):
+		"""
+		Move the files at <paths>, which are on the mount point <mount>,
+		into the trash.  Returns (path, error) tuples for the files which
+		couldn't be moved.
+		"""
+		trash_dir = self.directory_for(mount)
+		files_dir = join(trash_dir, 'files')
+		info_dir = join(trash_dir, 'info')
+		try:
+			for directory in (files_dir, info_dir):
+				if not isdir(directory):
+					os.makedirs(directory, 0o700)
+		except OSError as err:
+			return [(path, err) for path in paths]
+
+		errors = []
+		moved = []
+		date = time.strftime(DATE_FORMAT)
+		for path in paths:
+			try:
+				name = self._reserve(files_dir, info_dir, path, date)
+			except OSError as err:
+				errors.append((path, err))
+				continue
+			try:
+				os.rename(path, join(files_dir, name))
+			except OSError as err:
+				errors.append((path, err))
+				try:
+					os.remove(join(info_dir, name + INFO_SUFFIX))
+				except OSError:
+					pass
+			else:
+				moved.append(name)
+		if moved:
+			self._add_created(trash_dir, moved)
+			self.request_purge()
+		return errors
+
+	def _created_path(self):
+		if ranger.arg.clean:
+			return None
+		return self.fm.confpath('trashed')
+
+	def _load_created(self):
+		"""Read the names of ranger's files in the trash.  Needs the lock."""
+		if self._created is not None:
+			return
+		self._created = {}
+		path = self._created_path()
+		if path is None:
+			return
+		try:
+			created_file = open(path)
+		except IOError:
+			return
+		try:
+			for line in created_file:
+				try:
+					trash_dir, name = json.loads(line)
+				except ValueError:
+					continue
+				self._created.setdefault(trash_dir, set()).add(name)
+		finally:
+			created_file.close()
+
+	def _add_created(self, trash_dir, names):
+		with self._lock:
+			self._load_created()
+			self._created.setdefault(trash_dir, set()).update(names)
+			path = self._created_path()
+			if path is None:
+				return
+			try:
+				created_file = open(path, 'a')
+				try:
+					for name in names:
+						created_file.write(json.dumps([trash_dir, name]) + '\n')
+				finally:
+					created_file.close()
+			except IOError:
+				pass
+
+	def _forget_created(self, trash_dir, names):
+		"""Forget the names of files which are not in the trash anymore"""
+		with self._lock:
+			created = self._created.get(trash_dir)
+			if created is None:
+				return
+			created.difference_update(names)
+			if not created:
+				del self._created[trash_dir]
+			path = self._created_path()
+			if path is None:
+				return
+			try:
+				created_file = open(path + '.tmp', 'w')
+				try:
+					for other_dir, other_names in self._created.items():
+						for name in other_names:
+							created_file.write(json.dumps([other_dir, name])
+									+ '\n')
+				finally:
+					created_file.close()
+				os.rename(path + '.tmp', path)
+			except (IOError, OSError):
+				pass
+
+	@staticmethod
+	def _reserve(files_dir, info_dir, path, date):
+		"""
+		Create the info file for the path under a free name and return
+		the name.  Creating the info file reserves the name.
+		"""
+		name = candidate = basename(path)
+		number = 1
+		while True:
+			info_path = join(info_dir, candidate + INFO_SUFFIX)
+			try:
+				fd = os.open(info_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+						0o600)
+			except OSError as err:
+				if err.errno != EEXIST:
+					raise
+			else:
+				if not lexists(join(files_dir, candidate)):
+					break
+				os.close(fd)
+				os.remove(info_path)
+			number += 1
+			candidate = '{0}.{1}'.format(name, number)
+		try:
+			encoded_path = os.fsencode(path)
+		except AttributeError:
+			encoded_path = path
+		info = '[Trash Info]\nPath={0}\nDeletionDate={1}\n'.format(
+				quote(encoded_path), date)
+		try:
+			os.write(fd, info.encode('utf-8'))
+		finally:
+			os.close(fd)
+		return candidate
+
+	def request_purge(self):
+		"""Delete old files from the used trash directories in the background"""
+		self.purge_requested = True
+		if self.loadable is None:
+			self.loadable = Loadable(self._generate(),
+					"Purging old files from the trash")
+			self.loadable.threaded = True
+			self.fm.loader.add(self.loadable, append=True,
+					priority=PRIORITY_BULK)
+
+	def _generate(self):
+		try:
+			while self.purge_requested:
+				self.purge_requested = False
+				with self._lock:
+					self._load_created()
+					trash_dirs = tuple(self._created)
+				for trash_dir in trash_dirs:
+					for _ in self._purge(trash_dir):
+						yield
+		finally:
+			self.loadable = None
+
+	def _purge(self, trash_dir):
+		"""
+		Delete ranger's files which are older than trash_max_age, and the
+		oldest ones while they take more than trash_max_size.
+		"""
+		max_age = self.fm.settings.trash_max_age
+		max_size = self.fm.settings.trash_max_size
+		if max_age is None and max_size is None:
+			return
+		files_dir = join(trash_dir, 'files')
+		info_dir = join(trash_dir, 'info')
+		with self._lock:
+			names = tuple(self._created.get(trash_dir, ()))
+
+		entries = []  # (deletion time, name)
+		gone = []  # names which were restored or purged by someone else
+		for i, name in enumerate(names):
+			if i % 64 == 63:
+				yield
+			deletion_time = self._read_deletion_time(
+					join(info_dir, name + INFO_SUFFIX))
+			if deletion_time is None:
+				gone.append(name)
+			else:
+				entries.append((deletion_time, name))
+		entries.sort()
+
+		expired = []
+		if max_age is not None:
+			limit = time.time() - max_age
+			while entries and entries[0][0] < limit:
+				expired.append(entries.pop(0))
+		if max_size is not None:
+			sizes = []
+			for _, name in entries:
+				size = 0
+				for size in self._size(join(files_dir, name)):
+					yield
+				sizes.append(size)
+			total = sum(sizes)
+			while entries and total > max_size:
+				expired.append(entries.pop(0))
+				total -= sizes.pop(0)
+
+		for _, name in expired:
+			removal = Removal([join(files_dir, name)])
+			for _ in removal.generate():
+				yield
+			if not removal.errors:
+				try:
+					os.remove(join(info_dir, name + INFO_SUFFIX))
+				except OSError:
+					pass
+				gone.append(name)
+		if gone:
+			self._forget_created(trash_dir, gone)
+
+	def _size(self, path):
+		"""Yields the running totals of the size of the file or tree"""
+		try:
+			stat = os.lstat(path)
+		except OSError:
+			yield 0
+			return
+		if not isdir(path) or os.path.islink(path):
+			yield stat.st_size
+			return
+		for size, _ in self.tree_size.generate(path):
+			yield size
+
+	@staticmethod
+	def _read_deletion_time(info_path):
+		try:
+			info_file = open(info_path)
+			try:
+				for line in info_file:
+					if line.startswith('DeletionDate='):
+						date = line[len('DeletionDate='):].strip()
+						return time.mktime(time.strptime(date, DATE_FORMAT))
+			finally:
+				info_file.close()
+		except (IOError, OSError, ValueError):
+			pass
+		return None
@@ -0,0 +1,150 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+"""
+The DirectoryWatcher notices changes in the displayed directories.
+
+Without it, each displayed directory is stat'ed in every redraw to check
+whether its mtime changed.  With inotify, the kernel tells us about changes
+instead, and directories with a watch are never polled.
+"""
+
+import os
+from time import time
+from ranger.core.shared import FileManagerAware
+from ranger.ext.mount_path import is_network_filesystem
+from ranger.ext.inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, \
+		IN_MODIFY, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVED_FROM, IN_MOVED_TO, \
+		IN_MOVE_SELF, IN_ONLYDIR, IN_Q_OVERFLOW, IN_IGNORED, IN_UNMOUNT, \
+		IN_EXCL_UNLINK
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MODIFY | IN_CREATE | IN_DELETE \
+		| IN_DELETE_SELF | IN_MOVED_FROM | IN_MOVED_TO | IN_MOVE_SELF \
+		| IN_ONLYDIR | IN_EXCL_UNLINK
+
+# After these events, the whole directory needs to be reloaded
+RELOAD_ALL_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT | IN_IGNORED
+
+# A file which is written to while it's open, like a log or a download,
+# causes an IN_MODIFY with each write.  The directories are reloaded for
+# these at most once in this many seconds.
+MODIFY_INTERVAL = 1.0
+
+class DirectoryWatcher(FileManagerAware):
+	def __init__(self):
+		try:
+			self.inotify = Inotify()
+		except OSError:
+			self.inotify = None
+		self.watches = {}      # path -> wd
+		self.directories = {}  # wd -> Directory
+		self._modified = {}    # wd -> names, for the next MODIFY_INTERVAL
+		self._next_modify_time = 0
+
+	def fileno(self):
+		"""The file descriptor which is readable when there are events"""
+		if self.inotify is None:
+			return None
+		return self.inotify.fileno()
+
+	def update(self, directories):
+		"""Watch the given directories and stop watching all others"""
+		if self.inotify is None:
+			return
+		paths = {}
+		for directory in directories:
+			# inotify doesn't see changes made by other hosts, so keep
+			# polling directories on network file systems
+			if not is_network_filesystem(directory.mount_type):
+				paths[directory.path] = directory
+
+		for path in tuple(self.watches):
+			if path not in paths:
+				self._remove(path)
+
+		for path, directory in paths.items():
+			try:
+				wd = self.watches[path]
+			except KeyError:
+				self._add(directory)
+			else:
+				old_directory = self.directories[wd]
+				if old_directory is not directory:
+					old_directory.watched = False
+					self.directories[wd] = directory
+					directory.watched = True
+
+	def _add(self, directory):
+		try:
+			wd = self.inotify.add_watch(directory.path, WATCH_MASK)
+		except OSError:
+			return  # e.g. when running out of watches.  Poll instead.
+		self.watches[directory.path] = wd
+		self.directories[wd] = directory
+		directory.watched = True
+
+		# Catch changes from before the watch was added
+		if directory.content_loaded:
+			try:
+				mtime = os.stat(directory.path).st_mtime
+			except OSError:
+				mtime = None
+			if mtime != directory.load_content_mtime:
+				directory.request_reload()
+
+	def _remove(self, path):
+		wd = self.watches.pop(path)
+		directory = self.directories.pop(wd, None)
+		if directory is not None:
+			directory.watched = False
+		self._modified.pop(wd, None)
+		try:
+			self.inotify.rm_watch(wd)
+		except OSError:
+			pass
+
+	def handle_events(self):
+		"""Mark the directories which have changed as outdated"""
+		if self.inotify is None:
+			return
+		for wd, mask, cookie, name in self.inotify.read_events():
+			if mask & IN_Q_OVERFLOW:
+				for directory in self.directories.values():
+					directory.request_reload()
+				continue
+			directory = self.directories.get(wd)
+			if directory is None:
+				continue
+			if mask & RELOAD_ALL_MASK or not name:
+				directory.request_reload()
+			elif mask & WATCH_MASK == IN_MODIFY:
+				self._modified.setdefault(wd, set()).add(name)
+			else:
+				directory.request_partial_reload(name)
+			if mask & IN_IGNORED:
+				# The kernel removed this watch by itself
+				del self.directories[wd]
+				self._modified.pop(wd, None)
+				self.watches.pop(directory.path, None)
+				directory.watched = False
+
+		if self._modified:
+			now = time()
+			if now >= self._next_modify_time:
+				self._next_modify_time = now + MODIFY_INTERVAL
+				for wd, names in self._modified.items():
+					directory = self.directories.get(wd)
+					if directory is not None:
+						for name in names:
+							directory.request_partial_reload(name)
+				self._modified.clear()
+
+	def destroy(self):
+		if self.inotify is not None:
+			for directory in self.directories.values():
+				directory.watched = False
+			self.watches.clear()
+			self.directories.clear()
+			self._modified.clear()
+			self.inotify.close()
+			self.inotify = None
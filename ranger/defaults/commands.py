@@ -381,15 +381,13 @@ class find(Command):
 		if arg == '..':
 			return True
 
-		deq = deque(cwd.files)
+		deq = deque(cwd.get_names())
 		deq.rotate(-cwd.pointer)
 		i = 0
 		case_insensitive = arg.lower() == arg
-		for fsobj in deq:
+		for filename in deq:
 			if case_insensitive:
-				filename = fsobj.basename_lower
-			else:
-				filename = fsobj.basename
+				filename = filename.lower()
 			if arg in filename:
 				self.count += 1
 				if self.count == 1:
@@ -1026,7 +1024,6 @@ class filter(Command):
 
 	def execute(self):
 		self.fm.set_filter(self.rest(1))
-		self.fm.reload_cwd()
 
 
 class grep(Command):
@@ -105,11 +105,68 @@ padding_right = True
 autosave_bookmarks = True
 
 # You can display the "real" cumulative size of directories by using the
-# command :get_cumulative_size or typing "dc".  The size is expensive to
-# calculate and will not be updated automatically.  You can choose
+# command :get_cumulative_size or typing "dc".  The size is calculated in
+# the background and will not be updated automatically.  You can choose
 # to update it automatically though by turning on this option:
 autoupdate_cumulative_size = False
 
+# Directories with more files than this are displayed before all files are
+# stat'ed.  The visible files are stat'ed first and the others in the
+# background.  When sorting by size or time, the order is refined while the
+# information arrives.  None turns this off.
+background_stat_threshold = 5000
+
+# Directories with more files than this are stored in a compact form which
+# needs much less memory.  The objects for the files are only created while
+# they are displayed or otherwise used.  None turns this off.
+compact_threshold = 50000
+
+# When loading directories on these mount points, stat the files with
+# several threads at once.  This helps with network filesystems like NFS or
+# sshfs, where each stat has to wait for a round trip.  The keys are mount
+# points or file system types, the values are the number of threads, e.g.:
+# stat_threads = {'/mnt/nfs': 16, 'fuse.sshfs': 8}
+stat_threads = {}
+
+# When the loaded directories take up more memory than this (in bytes, a rough
+# estimate which includes the cached previews of their files), the least
+# recently used ones are unloaded and read again when they are needed.  None
+# turns this off.
+directory_memory_limit = 256 * 1024 * 1024
+
+# How many threads the loader may use for tasks which can block on slow or
+# hung file systems, like calculating the cumulative size of directories.
+# With 0, all tasks run in the main loop between key presses.
+loader_threads = 2
+
+# Move deleted files into the trash directory of their file system instead,
+# like ~/.local/share/Trash or /mnt/disk/.Trash-1000.  This is fast since
+# the files don't have to be deleted one by one.  Files which ranger moved
+# there and which are older than trash_max_age (in seconds) are purged in
+# the background, as well as the oldest ones while they take more than
+# trash_max_size (in bytes).  Files trashed by other programs are never
+# purged.  None turns a limit off.
+use_trash = False
+trash_max_age = 30 * 24 * 60 * 60
+trash_max_size = None
+
+# Pasting copies small files with this many threads at once, which is faster
+# when each file takes a round trip, like on network file systems.
+copy_threads = 4
+
+# Pasting keeps a journal of the finished files in ~/.config/ranger/transfers,
+# so a paste which was interrupted by quitting ranger is resumed at the next
+# start, skipping the files which match already.  With this option, the
+# journal also stores checksums of the files, and resuming checks them.
+transfer_checksums = False
+
+# Remember the listings of large directories in ~/.config/ranger/listing_cache
+# so they appear instantly the next time.  The cached listing is only used if
+# the directory was not modified since, and the files are checked again in
+# the background.  This is the size limit of the cache in bytes; None turns
+# it off.
+listing_cache_size = 32 * 1024 * 1024
+
 # Makes sense for screen readers:
 show_cursor = False
 
@@ -0,0 +1,111 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+"""
+A minimal ctypes binding for the inotify API of the linux kernel.
+
+Create an Inotify object, add watches with add_watch() and collect the
+events with read_events(), which never blocks.  If inotify is not available
+on this system, creating an Inotify object raises an OSError.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+IN_ACCESS        = 0x00000001
+IN_MODIFY        = 0x00000002
+IN_ATTRIB        = 0x00000004
+IN_CLOSE_WRITE   = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN          = 0x00000020
+IN_MOVED_FROM    = 0x00000040
+IN_MOVED_TO      = 0x00000080
+IN_CREATE        = 0x00000100
+IN_DELETE        = 0x00000200
+IN_DELETE_SELF   = 0x00000400
+IN_MOVE_SELF     = 0x00000800
+IN_UNMOUNT       = 0x00002000
+IN_Q_OVERFLOW    = 0x00004000
+IN_IGNORED       = 0x00008000
+IN_ONLYDIR       = 0x01000000
+IN_DONT_FOLLOW   = 0x02000000
+IN_EXCL_UNLINK   = 0x04000000
+
+IN_CLOEXEC       = 0o2000000
+IN_NONBLOCK      = 0o0004000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+	global _libc
+	if _libc is None:
+		try:
+			_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+					use_errno=True)
+			_libc.inotify_init1
+		except (OSError, AttributeError):
+			raise OSError(errno.ENOSYS, "inotify is not available")
+	return _libc
+
+if sys.version_info >= (3, ):
+	_encode = os.fsencode
+	_decode = os.fsdecode
+else:
+	_encode = _decode = lambda name: name
+
+class Inotify(object):
+	def __init__(self):
+		self._libc = _get_libc()
+		self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+
+	def fileno(self):
+		return self.fd
+
+	def add_watch(self, path, mask):
+		"""Watch <path> for the events in <mask>, returns a watch descriptor"""
+		wd = self._libc.inotify_add_watch(self.fd, _encode(path), mask)
+		if wd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err), path)
+		return wd
+
+	def rm_watch(self, wd):
+		self._libc.inotify_rm_watch(self.fd, wd)
+
+	def read_events(self):
+		"""
+		Returns a list of (wd, mask, cookie, name) tuples for the events
+		that are queued up, or an empty list if there are none.
+		"""
+		events = []
+		while True:
+			try:
+				data = os.read(self.fd, 64 * 1024)
+			except OSError as err:
+				if err.errno == errno.EINTR:
+					continue
+				if err.errno == errno.EAGAIN:
+					return events
+				raise
+			offset = 0
+			while offset < len(data):
+				wd, mask, cookie, length = \
+						_EVENT_HEADER.unpack_from(data, offset)
+				offset += _EVENT_HEADER.size
+				name = data[offset:offset + length].rstrip(b'\0')
+				offset += length
+				events.append((wd, mask, cookie, _decode(name)))
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
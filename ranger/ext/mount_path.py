@@ -1,13 +1,110 @@
 # Copyright (C) 2009, 2010, 2011  Roman Zimbelmann <romanz@lavabit.com>
 # This software is distributed under the terms of the GNU GPL version 3.
 
+"""
+Find out on which mount point a path is and what file system it uses.
+
+On linux, the mount table is read from /proc/self/mountinfo and read again
+only when the kernel reports a change of it.  Elsewhere, the mount point is
+found by checking each parent directory with os.path.ismount(), and the
+file system type is unknown.
+"""
+
+import re
+import select
 from os.path import realpath, abspath, dirname, ismount
 
+MOUNTINFO = '/proc/self/mountinfo'
+
+# Changes on these file systems are not noticed by inotify and each stat
+# waits for a round trip.  FUSE file systems are counted as well.
+NETWORK_FILESYSTEMS = frozenset(('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs',
+	'ncpfs', 'afs', '9p', 'ceph', 'glusterfs', 'lustre', 'davfs', 'sshfs'))
+
+_escape_re = re.compile(r'\\([0-7]{3})')
+
+def _unescape(string):
+	return _escape_re.sub(lambda match: chr(int(match.group(1), 8)), string)
+
+def parse_mountinfo(text):
+	r"""
+	Returns a dict of the mount points and their file system types
+
+	>>> line = '36 35 98:0 / /mnt/my\\040disk rw - ext3 /dev/sda1 rw\n'
+	>>> parse_mountinfo(line)
+	{'/mnt/my disk': 'ext3'}
+	>>> line = '21 1 0:19 / /proc rw shared:12 master:1 - proc proc rw\n'
+	>>> parse_mountinfo(line)
+	{'/proc': 'proc'}
+	"""
+	mounts = {}
+	for line in text.splitlines():
+		fields = line.split(' ')
+		try:
+			separator = fields.index('-', 6)
+			mounts[_unescape(fields[4])] = fields[separator + 1]
+		except (ValueError, IndexError):
+			continue
+	return mounts
+
+def is_network_filesystem(fstype):
+	"""
+	>>> is_network_filesystem('nfs4'), is_network_filesystem('fuse.sshfs')
+	(True, True)
+	>>> is_network_filesystem('ext4'), is_network_filesystem(None)
+	(False, False)
+	"""
+	if fstype is None:
+		return False
+	return fstype in NETWORK_FILESYSTEMS or fstype.startswith('fuse')
+
+class MountTable(object):
+	def __init__(self, path=MOUNTINFO):
+		self.mounts = None
+		self._file = None
+		try:
+			self._file = open(path)
+			self._poll = select.poll()
+			self._poll.register(self._file.fileno(),
+					select.POLLPRI | select.POLLERR)
+		except (IOError, OSError, AttributeError):
+			# No mountinfo or no poll(), use ismount() instead
+			self._file = None
+
+	def _update(self):
+		if self.mounts is None or self._poll.poll(0):
+			self._file.seek(0)
+			self.mounts = parse_mountinfo(self._file.read())
+
+	def lookup(self, path):
+		"""Returns the mount point of the path and its file system type"""
+		path = abspath(realpath(path))
+		if self._file is None:
+			while path != '/':
+				if ismount(path):
+					return path, None
+				path = dirname(path)
+			return '/', None
+
+		self._update()
+		mounts = self.mounts
+		while path not in mounts and path != '/':
+			path = dirname(path)
+		return path, mounts.get(path)
+
+_mount_table = None
+
+def mount_info(path):
+	"""Get the mount root of a directory and its file system type"""
+	global _mount_table
+	if _mount_table is None:
+		_mount_table = MountTable()
+	return _mount_table.lookup(path)
+
 def mount_path(path):
 	"""Get the mount root of a directory"""
-	path = abspath(realpath(path))
-	while path != '/':
-		if ismount(path):
-			return path
-		path = dirname(path)
-	return '/'
+	return mount_info(path)[0]
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,77 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+import threading
+
+class _Pending(object):
+	def __repr__(self):
+		return 'PENDING'
+
+PENDING = _Pending()
+
+class _Failure(object):
+	def __init__(self, error):
+		self.error = error
+
+def parallel_map(function, items, workers, timeout=0.005):
+	"""
+	Apply function to each item with a pool of threads.
+
+	Returns a generator which yields the results in the order of the items.
+	If the next result is not ready after waiting <timeout> seconds,
+	PENDING is yielded instead so the caller can do something else in the
+	meantime.  Exceptions are re-raised in the caller.  Closing the
+	generator stops the threads after their current item.
+
+	>>> results = parallel_map(lambda x: x * 2, range(5), workers=3)
+	>>> [result for result in results if result is not PENDING]
+	[0, 2, 4, 6, 8]
+	>>> list(parallel_map(len, [], workers=3))
+	[]
+	"""
+	items = list(items)
+	results = [PENDING] * len(items)
+	condition = threading.Condition()
+	state = {'next': 0}
+
+	def work():
+		while True:
+			with condition:
+				index = state['next']
+				if index >= len(items):
+					return
+				state['next'] = index + 1
+			try:
+				result = function(items[index])
+			except Exception as error:
+				result = _Failure(error)
+			with condition:
+				results[index] = result
+				condition.notify_all()
+
+	for _ in range(min(workers, len(items))):
+		thread = threading.Thread(target=work)
+		thread.daemon = True
+		thread.start()
+
+	try:
+		for index in range(len(items)):
+			while True:
+				with condition:
+					if results[index] is PENDING:
+						condition.wait(timeout)
+					result = results[index]
+				if result is not PENDING:
+					break
+				yield PENDING
+			results[index] = None
+			if isinstance(result, _Failure):
+				raise result.error
+			yield result
+	finally:
+		with condition:
+			state['next'] = len(items)
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
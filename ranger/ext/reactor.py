@@ -0,0 +1,109 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+import os
+import select
+from errno import EINTR, EAGAIN
+
+class Reactor(object):
+	"""
+	Waits for data on many file descriptors at once.
+
+	Each registered file descriptor has a handler, which is called with
+	the data read from it, or with an empty string at the end of file.
+	Then the handler should unregister the file descriptor.  poll() waits
+	for all of them with one epoll (or select) call.
+
+	>>> reactor = Reactor()
+	>>> read_fd, write_fd = os.pipe()
+	>>> received = []
+	>>> reactor.register(read_fd, received.append)
+	>>> reactor.poll(0)
+	False
+	>>> os.write(write_fd, b'hello') and os.close(write_fd)
+	>>> reactor.poll(1), received == [b'hello']
+	(True, True)
+	>>> reactor.poll(1), received == [b'hello', b'']
+	(True, True)
+	>>> reactor.unregister(read_fd)
+	>>> os.close(read_fd)
+	>>> reactor.destroy()
+	"""
+
+	chunk_size = 65536
+
+	def __init__(self):
+		self._handlers = {}
+		if hasattr(select, 'epoll'):
+			self._epoll = select.epoll()
+		else:
+			self._epoll = None
+		self._wakeup_read, self._wakeup_write = os.pipe()
+		self.register(self._wakeup_read, lambda data: None)
+
+	def register(self, fd, handler):
+		self._handlers[fd] = handler
+		if self._epoll is not None:
+			self._epoll.register(fd, select.EPOLLIN)
+
+	def unregister(self, fd):
+		if self._handlers.pop(fd, None) is not None \
+				and self._epoll is not None:
+			try:
+				self._epoll.unregister(fd)
+			except (IOError, OSError, ValueError):
+				pass
+
+	def wakeup(self):
+		"""Make a waiting poll() return.  Any thread may call this."""
+		try:
+			os.write(self._wakeup_write, b'.')
+		except OSError:
+			pass
+
+	def poll(self, timeout=0, fds=()):
+		"""
+		Wait up to <timeout> seconds until one of the registered file
+		descriptors, or one of the other <fds>, is ready for reading.  Then
+		read from the registered ones and call their handlers.  Returns
+		whether any file descriptor was ready.
+		"""
+		try:
+			if self._epoll is not None:
+				for fd in fds:
+					self._epoll.register(fd, select.EPOLLIN)
+				try:
+					ready = [fd for fd, event in self._epoll.poll(timeout)]
+				finally:
+					for fd in fds:
+						self._epoll.unregister(fd)
+			else:
+				ready = select.select(list(self._handlers) + list(fds),
+						[], [], timeout)[0]
+		except (select.error, IOError, OSError) as err:
+			if err.args[0] == EINTR:
+				return False
+			raise
+
+		for fd in ready:
+			handler = self._handlers.get(fd)
+			if handler is None:
+				continue
+			try:
+				data = os.read(fd, self.chunk_size)
+			except OSError as err:
+				if err.errno in (EINTR, EAGAIN):
+					continue
+				data = b''
+			handler(data)
+		return bool(ready)
+
+	def destroy(self):
+		os.close(self._wakeup_read)
+		os.close(self._wakeup_write)
+		if self._epoll is not None:
+			self._epoll.close()
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
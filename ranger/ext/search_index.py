@@ -0,0 +1,144 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+from array import array
+from bisect import bisect_right
+
+# Can't be part of a file name
+SEPARATOR = '\0'
+
+# Regexps containing these may match differently inside the joined text
+CONTEXT_SENSITIVE = ('^', '$', '\\A', '\\Z', '\\b', '\\B',
+		'(?=', '(?!', '(?<')
+
+class SearchIndex(object):
+	"""
+	Finds the names which contain a string or match a regular expression.
+
+	The names are joined into one string, so all of them are searched with
+	one call of str.find or pattern.search instead of one per name.  The
+	positions of the matching names are remembered for each query, so
+	jumping to the next match is a binary search.
+
+	>>> import re
+	>>> index = SearchIndex(['foo', 'bar', 'Foobar', 'baz'])
+	>>> list(index.matches('bar'))
+	[1, 2]
+	>>> list(index.matches(re.compile('^f', re.I)))
+	[0, 2]
+	>>> list(index.matches(re.compile('o+b|z$')))
+	[2, 3]
+	>>> list(index.matches(re.compile('r.b')))
+	[]
+	>>> index.next_match('ba', 2), index.next_match('ba', 2, forward=False)
+	(3, 1)
+	>>> index.next_match('Foo', 3), index.next_match('Foo', 2)
+	(2, None)
+	"""
+
+	# How many queries the matches are remembered for
+	max_cached = 16
+
+	def __init__(self, names):
+		self.text = SEPARATOR.join(names)
+		self.starts = array('L')
+		start = 0
+		for name in names:
+			self.starts.append(start)
+			start += len(name) + 1
+		self._matches = {}
+
+	def __len__(self):
+		return len(self.starts)
+
+	def name(self, index):
+		start = self.starts[index]
+		return self.text[start:self.text.find(SEPARATOR, start)
+				if index + 1 < len(self.starts) else len(self.text)]
+
+	def matches(self, query):
+		"""
+		Returns a sorted list of the indices of the names which contain
+		<query>, a string, or in which <query>, a compiled regexp, finds a
+		match.
+		"""
+		try:
+			return self._matches[query]
+		except KeyError:
+			pass
+		if not self.starts:
+			matches = []
+		elif hasattr(query, 'search'):
+			matches = self._search(query)
+		else:
+			matches = self._find(query)
+		if len(self._matches) >= self.max_cached:
+			self._matches.clear()
+		self._matches[query] = matches
+		return matches
+
+	def next_match(self, query, index, forward=True):
+		"""
+		Returns the index of the next matching name after <index> in the
+		given direction, wrapping around, or None if only <index> matches.
+		"""
+		matches = self.matches(query)
+		if not matches:
+			return None
+		if forward:
+			i = bisect_right(matches, index)
+			result = matches[i % len(matches)]
+		else:
+			i = bisect_right(matches, index - 1) - 1
+			result = matches[i]
+		if result == index:
+			return None
+		return result
+
+	def _position(self, offset):
+		"""The index of the name at the offset in the text"""
+		return bisect_right(self.starts, offset) - 1
+
+	def _find(self, string):
+		matches = []
+		if SEPARATOR in string:
+			return matches
+		text = self.text
+		offset = text.find(string)
+		while offset != -1:
+			index = self._position(offset)
+			matches.append(index)
+			if index + 1 >= len(self.starts):
+				break
+			offset = text.find(string, self.starts[index + 1])
+		return matches
+
+	def _search(self, pattern):
+		"""
+		A match in the joined text may cross into the following names, so
+		each name is checked again on its own, and the search continues at
+		the next name.  Unless the regexp looks at the text around a match,
+		a match inside a name is also a match in the joined text, so every
+		matching name is found.
+		"""
+		matches = []
+		text = self.text
+		starts = self.starts
+		if any(part in pattern.pattern for part in CONTEXT_SENSITIVE):
+			for index, name in enumerate(text.split(SEPARATOR)):
+				if pattern.search(name):
+					matches.append(index)
+			return matches
+		match = pattern.search(text)
+		while match is not None:
+			index = self._position(match.start())
+			if pattern.search(self.name(index)):
+				matches.append(index)
+			if index + 1 >= len(starts):
+				break
+			match = pattern.search(text, starts[index + 1])
+		return matches
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
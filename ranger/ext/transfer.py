@@ -0,0 +1,934 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+"""
+Copying, moving, linking and deleting files bit by bit, for the loader.
+
+The work is done by generators which yield often, so it can be paused,
+cancelled and watched while it runs.  File contents are copied inside the
+kernel with copy_file_range or sendfile where possible, otherwise with
+large reads and writes.  Like cp -a, copies keep the permissions, times,
+extended attributes and, where permitted, the owner of the originals.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from errno import EEXIST, EINVAL, ENOSYS, ENOTSUP, EOPNOTSUPP, EPERM, \
+		EXDEV, ETXTBSY, EBADF, EISDIR, ELOOP
+from os.path import basename, dirname, isdir, islink, join, lexists, split
+from stat import S_IFMT, S_IMODE, S_ISBLK, S_ISCHR, S_ISDIR, S_ISFIFO, \
+		S_ISLNK, S_ISREG
+from time import time
+try:
+	from os import scandir
+except ImportError:
+	scandir = None
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from ranger.ext.parallel_map import parallel_map, PENDING
+
+CHUNK_SIZE = 1024 * 1024
+
+# Errors of copy_file_range and sendfile after which the next method is tried
+_UNSUPPORTED = (EINVAL, ENOSYS, ENOTSUP, EOPNOTSUPP, EXDEV, ETXTBSY, EBADF)
+
+def walk(path, onerror=None, follow_links=False):
+	"""
+	Yields (path, lstat result) for the tree at <path>, each directory
+	before its contents.  If <path> or one of the directories can't be
+	read, onerror is called with the OSError and the walk goes on without
+	it.  Symlinks are only followed with <follow_links>, then the stat
+	results are of the targets.  A link to a directory which contains
+	the link is reported to onerror with ELOOP.
+
+	>>> import tempfile
+	>>> tmp = tempfile.mkdtemp()
+	>>> os.makedirs(join(tmp, 'a', 'b'))
+	>>> open(join(tmp, 'a', 'c'), 'w').close()
+	>>> sorted(name[len(tmp):] for name, stat in walk(tmp))
+	['', '/a', '/a/b', '/a/c']
+	>>> os.symlink(join(tmp, 'a'), join(tmp, 'a', 'b', 'loop'))
+	>>> errors = []
+	>>> sorted(name[len(tmp):] for name, stat in walk(tmp, errors.append,
+	...         follow_links=True))
+	['', '/a', '/a/b', '/a/c']
+	>>> [err.errno == ELOOP for err in errors]
+	[True]
+	>>> for _ in Removal([tmp]).generate(): pass
+	"""
+	get_stat = os.stat if follow_links else os.lstat
+	# The (dev, inode) pairs of the directories above each path
+	stack = [(path, None, frozenset())]
+	while stack:
+		path, stat, parents = stack.pop()
+		try:
+			if stat is None:
+				stat = get_stat(path)
+		except OSError as err:
+			if onerror is not None:
+				onerror(err)
+			continue
+		if not S_ISDIR(stat.st_mode):
+			yield path, stat
+			continue
+		if follow_links:
+			key = (stat.st_dev, stat.st_ino)
+			if key in parents:
+				if onerror is not None:
+					onerror(OSError(ELOOP, "Symlink loop", path))
+				continue
+			parents = parents | frozenset((key, ))
+		yield path, stat
+		try:
+			if scandir is None:
+				stack.extend((join(path, name), None, parents)
+						for name in os.listdir(path))
+			else:
+				for entry in scandir(path):
+					try:
+						stat = entry.stat(follow_symlinks=follow_links)
+					except OSError:
+						stat = None
+					stack.append((entry.path, stat, parents))
+		except OSError as err:
+			if onerror is not None:
+				onerror(err)
+
+def backup_name(path):
+	"""A free name for a backup of <path>, like cp --backup=numbered"""
+	number = 1
+	while lexists('{0}.~{1}~'.format(path, number)):
+		number += 1
+	return '{0}.~{1}~'.format(path, number)
+
+def copy_file(source, target, chunk_size=CHUNK_SIZE):
+	"""
+	Copy the contents of the regular file <source> to <target>, yielding
+	the number of bytes copied in each step.
+	"""
+	source_fd = os.open(source, os.O_RDONLY)
+	try:
+		mode = S_IMODE(os.fstat(source_fd).st_mode) | 0o200
+		target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+				mode)
+		try:
+			for done in _copy_contents(source_fd, target_fd, chunk_size):
+				yield done
+		finally:
+			os.close(target_fd)
+	finally:
+		os.close(source_fd)
+
+def _copy_contents(source_fd, target_fd, chunk_size):
+	# Each method continues at the file offsets where the last one stopped
+	if hasattr(os, 'copy_file_range'):
+		try:
+			while True:
+				done = os.copy_file_range(source_fd, target_fd, chunk_size)
+				if not done:
+					return
+				yield done
+		except OSError as err:
+			if err.errno not in _UNSUPPORTED:
+				raise
+	if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+		try:
+			while True:
+				done = os.sendfile(target_fd, source_fd, None, chunk_size)
+				if not done:
+					return
+				yield done
+		except OSError as err:
+			if err.errno not in _UNSUPPORTED:
+				raise
+	while True:
+		data = os.read(source_fd, chunk_size)
+		if not data:
+			return
+		view = memoryview(data)
+		while view:
+			view = view[os.write(target_fd, view):]
+		yield len(data)
+
+def copy_metadata(source, target, stat):
+	"""
+	Give <target> the owner, permissions, times and extended attributes
+	of <source>, whose lstat result is <stat>.  Changing the owner is
+	skipped where it isn't permitted.
+	"""
+	is_link = S_ISLNK(stat.st_mode)
+	try:
+		if is_link:
+			os.lchown(target, stat.st_uid, stat.st_gid)
+		else:
+			os.chown(target, stat.st_uid, stat.st_gid)
+	except OSError as err:
+		if err.errno not in (EPERM, EINVAL):
+			raise
+	if hasattr(os, 'listxattr'):
+		_copy_xattrs(source, target, is_link)
+	if is_link:
+		if os.utime not in getattr(os, 'supports_follow_symlinks', ()):
+			return
+		os.utime(target, ns=(stat.st_atime_ns, stat.st_mtime_ns),
+				follow_symlinks=False)
+		return
+	os.chmod(target, S_IMODE(stat.st_mode))
+	if hasattr(stat, 'st_mtime_ns'):
+		os.utime(target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+	else:
+		os.utime(target, (stat.st_atime, stat.st_mtime))
+
+def _copy_xattrs(source, target, is_link):
+	follow = not is_link
+	try:
+		names = os.listxattr(source, follow_symlinks=follow)
+	except OSError as err:
+		if err.errno in (ENOTSUP, EOPNOTSUPP, EPERM):
+			return
+		raise
+	for name in names:
+		try:
+			value = os.getxattr(source, name, follow_symlinks=follow)
+			os.setxattr(target, name, value, follow_symlinks=follow)
+		except OSError as err:
+			if err.errno not in (ENOTSUP, EOPNOTSUPP, EPERM):
+				raise
+
+
+class Transfer(object):
+	"""
+	Copies or moves files into a directory.
+
+	Like cp -a and mv --backup=numbered, existing files are renamed to a
+	numbered backup name first, unless <overwrite> is true.  Directories
+	which exist already are merged.  Moving renames the files if they are
+	on the same file system, otherwise they are copied and then removed.
+
+	Small files are copied by <threads> threads at once, which helps when
+	each file takes a round trip, like on network file systems.  Errors
+	don't stop the transfer, they are collected in the errors attribute.
+
+	With a Journal, the finished files are recorded, and files which the
+	journal knows as finished are skipped if they still match.
+
+	>>> import tempfile
+	>>> tmp = tempfile.mkdtemp()
+	>>> os.makedirs(join(tmp, 'src', 'dir'))
+	>>> os.mkdir(join(tmp, 'dest'))
+	>>> def write(name):
+	...     f = open(join(tmp, name), 'w')
+	...     f.write(name)
+	...     f.close()
+	>>> for name in ('src/a', 'src/dir/b', 'dest/a'):
+	...     write(name)
+	>>> transfer = Transfer([join(tmp, 'src/a'), join(tmp, 'src/dir')],
+	...         join(tmp, 'dest'), threads=2)
+	>>> for _ in transfer.generate(): pass
+	>>> sorted(os.listdir(join(tmp, 'dest')))
+	['a', 'a.~1~', 'dir']
+	>>> open(join(tmp, 'dest/a')).read(), open(join(tmp, 'dest/dir/b')).read()
+	('src/a', 'src/dir/b')
+	>>> transfer.done_bytes == transfer.total_bytes == 14, transfer.errors
+	(True, [])
+	>>> transfer = Transfer([join(tmp, 'dest/a.~1~')], join(tmp, 'src'),
+	...         move=True)
+	>>> for _ in transfer.generate(): pass
+	>>> sorted(os.listdir(join(tmp, 'src'))), transfer.errors
+	(['a', 'a.~1~', 'dir'], [])
+	>>> for _ in Removal([tmp]).generate(): pass
+	"""
+
+	chunk_size = CHUNK_SIZE
+	small_file_size = 256 * 1024  # smaller files are copied by several threads
+	batch_size = 64  # how many small files are copied at once
+
+	def __init__(self, paths, target_dir, move=False, overwrite=False,
+			threads=1, journal=None):
+		self.paths = list(paths)
+		self.target_dir = target_dir
+		self.move = move
+		self.overwrite = overwrite
+		self.threads = threads
+		self.journal = journal
+		self.planned = False  # whether total_bytes/total_files are known
+		self.total_bytes = 0
+		self.total_files = 0
+		self.done_bytes = 0
+		self.done_files = 0
+		self.errors = []  # (path, exception) tuples
+
+	def generate(self):
+		"""Returns a generator which does the work, yielding now and then"""
+		plans = []
+		for path in self.paths:
+			target = self._target(path)
+			if target is None:
+				continue
+			if self.move:
+				if self.journal is not None and path in self.journal.moved:
+					self.total_files += 1
+					self.done_files += 1
+					continue
+				try:
+					self._rename(path, target)
+					continue
+				except OSError as err:
+					if err.errno != EXDEV:
+						self._error(path, err)
+						continue
+			jobs = []
+			for _ in self._plan(path, target, jobs):
+				yield
+			plans.append((path, jobs))
+		self.planned = True
+		yield
+
+		for path, jobs in plans:
+			errors = len(self.errors)
+			for _ in self._copy(jobs):
+				yield
+			if self.move and len(self.errors) == errors:
+				removal = Removal([path])
+				for _ in removal.generate():
+					yield
+				self.errors.extend(removal.errors)
+			yield
+
+	def _target(self, path):
+		"""The path to copy or move <path> to, or None if there is none"""
+		if self.journal is not None and path in self.journal.targets:
+			return self.journal.targets[path]
+		target = join(self.target_dir, basename(path))
+		if target == path:
+			if self.move or self.overwrite:
+				return None
+			target = backup_name(path)
+		elif (target + os.sep).startswith(path + os.sep):
+			self._error(path, OSError(EINVAL,
+					"Can't copy a directory into itself"))
+			return None
+		if self.journal is not None:
+			self.journal.set_target(path, target)
+		return target
+
+	def _rename(self, path, target):
+		if lexists(target) and not self.overwrite:
+			os.rename(target, backup_name(target))
+		os.rename(path, target)
+		if self.journal is not None:
+			self.journal.set_moved(path)
+		self.total_files += 1
+		self.done_files += 1
+
+	def _plan(self, path, target, jobs):
+		"""Append (path, target, stat) for each file to <jobs>"""
+		offset = len(path)
+		onerror = lambda err: self._error(err.filename or path, err)
+		for i, (name, stat) in enumerate(walk(path, onerror)):
+			jobs.append((name, target + name[offset:], stat))
+			self.total_files += 1
+			if S_ISREG(stat.st_mode):
+				self.total_bytes += stat.st_size
+			if i % 256 == 255:
+				yield
+
+	def _copy(self, jobs):
+		directories = []
+		failed = set()  # directories which couldn't be created
+		linked = {}  # (device, inode) -> target, for files with hard links
+		batch = []
+		journal = self.journal
+		for path, target, stat in jobs:
+			if dirname(path) in failed:
+				failed.add(path)
+				continue
+			mode = stat.st_mode
+			if journal is not None and not S_ISDIR(mode) \
+					and journal.is_done(target, stat):
+				if S_ISREG(mode):
+					self.done_bytes += stat.st_size
+					if stat.st_nlink > 1:
+						linked[stat.st_dev, stat.st_ino] = target
+				self.done_files += 1
+				continue
+			if S_ISREG(mode) and self.threads > 1 and stat.st_nlink == 1 \
+					and stat.st_size < self.small_file_size:
+				batch.append((path, target, stat))
+				if len(batch) >= self.batch_size:
+					for _ in self._copy_batch(batch):
+						yield
+					batch = []
+				continue
+			try:
+				self._prepare(target, S_ISDIR(mode))
+				if S_ISDIR(mode):
+					if not isdir(target):
+						os.mkdir(target, S_IMODE(mode) | 0o700)
+					directories.append((path, target, stat))
+				elif S_ISREG(mode) and (stat.st_dev, stat.st_ino) in linked:
+					os.link(linked[stat.st_dev, stat.st_ino], target)
+					self.done_bytes += stat.st_size
+				elif S_ISREG(mode):
+					if journal is not None:
+						journal.set_started(target)
+					for done in copy_file(path, target, self.chunk_size):
+						self.done_bytes += done
+						yield
+					copy_metadata(path, target, stat)
+					if stat.st_nlink > 1:
+						linked[stat.st_dev, stat.st_ino] = target
+				else:
+					self._copy_special(path, target, stat)
+				if journal is not None and not S_ISDIR(mode):
+					journal.set_done(target, stat, self._checksum(target))
+			except (OSError, IOError) as err:
+				self._error(path, err)
+				if S_ISDIR(mode):
+					failed.add(path)
+				continue
+			self.done_files += 1
+			yield
+		for _ in self._copy_batch(batch):
+			yield
+
+		# Set the times of directories after their contents were added
+		for path, target, stat in reversed(directories):
+			try:
+				copy_metadata(path, target, stat)
+			except OSError as err:
+				self._error(path, err)
+
+	def _copy_batch(self, batch):
+		def copy(job):
+			path, target, stat = job
+			try:
+				self._prepare(target, False)
+				if self.journal is not None:
+					self.journal.set_started(target)
+				for _ in copy_file(path, target, self.chunk_size):
+					pass
+				copy_metadata(path, target, stat)
+				return None, self._checksum(target)
+			except (OSError, IOError) as err:
+				return err, None
+
+		results = parallel_map(copy, batch, workers=self.threads)
+		index = 0
+		for result in results:
+			if result is PENDING:
+				yield
+				continue
+			error, checksum = result
+			path, target, stat = batch[index]
+			index += 1
+			if error is None:
+				if self.journal is not None:
+					self.journal.set_done(target, stat, checksum)
+				self.done_bytes += stat.st_size
+				self.done_files += 1
+			else:
+				self._error(path, error)
+			yield
+
+	def _checksum(self, path):
+		if self.journal is None or not self.journal.checksums \
+				or islink(path) or not os.path.isfile(path):
+			return None
+		return file_checksum(path)
+
+	def _copy_special(self, path, target, stat):
+		mode = stat.st_mode
+		if S_ISLNK(mode):
+			os.symlink(os.readlink(path), target)
+		elif S_ISFIFO(mode):
+			os.mkfifo(target, S_IMODE(mode))
+		elif S_ISCHR(mode) or S_ISBLK(mode):
+			os.mknod(target, mode, stat.st_rdev)
+		else:
+			raise OSError(ENOTSUP, "Can't copy this type of file", path)
+		copy_metadata(path, target, stat)
+
+	def _prepare(self, target, is_dir):
+		"""Make way for a new file at <target>"""
+		if not lexists(target):
+			return
+		target_is_dir = isdir(target) and not islink(target)
+		if is_dir and target_is_dir:
+			return
+		if self.journal is not None and target in self.journal.interrupted \
+				and not target_is_dir:
+			os.remove(target)  # an incomplete copy
+		elif not self.overwrite:
+			os.rename(target, backup_name(target))
+		elif target_is_dir:
+			raise OSError(EISDIR, "Can't overwrite a directory", target)
+		elif is_dir:
+			raise OSError(EEXIST, "Can't overwrite a file with a directory",
+					target)
+		else:
+			os.remove(target)
+
+	def _error(self, path, error):
+		self.errors.append((path, error))
+
+
+class Journal(object):
+	"""
+	Records the progress of a Transfer in a file, so it can be resumed.
+
+	The file has one JSON object per line: first the parameters of the
+	transfer, then the target of each path, the paths which were moved by
+	renaming them, each started file, and each finished file with the
+	size and mtime of the original, and optionally a checksum.  Files
+	which were started but not finished are replaced when resuming.
+	Since lines are only appended, an interrupted write loses at most the
+	last record.  While a journal is open, its file is locked, so only one
+	ranger resumes it.
+
+	>>> import tempfile
+	>>> tmp = tempfile.mkdtemp()
+	>>> os.makedirs(join(tmp, 'src', 'dir'))
+	>>> os.mkdir(join(tmp, 'dest'))
+	>>> for name in ('src/a', 'src/dir/b'):
+	...     open(join(tmp, name), 'w').close()
+	>>> journal = Journal.create(join(tmp, 'journals'), [join(tmp, 'src')],
+	...         join(tmp, 'dest'), checksums=True)
+	>>> for _ in Transfer(journal.paths, journal.target_dir,
+	...         journal=journal).generate(): pass
+	>>> journal.close()
+	>>> journal = list(Journal.find(join(tmp, 'journals')))[0]
+	>>> transfer = Transfer(journal.paths, journal.target_dir,
+	...         journal=journal)
+	>>> for _ in transfer.generate(): pass
+	>>> sorted(os.listdir(join(tmp, 'dest', 'src'))), transfer.done_files
+	(['a', 'dir'], 4)
+	>>> journal.close(remove=True)
+	>>> list(Journal.find(join(tmp, 'journals')))
+	[]
+	>>> for _ in Removal([tmp]).generate(): pass
+	"""
+
+	suffix = '.journal'
+
+	def __init__(self, path):
+		self.path = path
+		self.paths = []
+		self.target_dir = None
+		self.move = False
+		self.overwrite = False
+		self.checksums = False
+		self.description = None
+		self.targets = {}  # path -> target
+		self.moved = set()  # paths which were moved by renaming them
+		self.done = {}  # target -> (size, mtime, checksum)
+		self.interrupted = set()  # targets which were started before
+		self._file = None
+		self._lock = threading.Lock()
+
+	@classmethod
+	def create(cls, directory, paths, target_dir, move=False,
+			overwrite=False, checksums=False, description=None):
+		"""Start a new journal in <directory>"""
+		if not isdir(directory):
+			os.makedirs(directory, 0o700)
+		number = 0
+		while True:
+			path = join(directory, '{0}-{1}-{2}{3}'.format(int(time()),
+					os.getpid(), number, cls.suffix))
+			try:
+				os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+						0o600))
+				break
+			except OSError as err:
+				if err.errno != EEXIST:
+					raise
+				number += 1
+		journal = cls(path)
+		journal._open()
+		journal.paths = list(paths)
+		journal.target_dir = target_dir
+		journal.move = move
+		journal.overwrite = overwrite
+		journal.checksums = checksums
+		journal.description = description
+		journal._write(paths=journal.paths, target_dir=target_dir,
+				move=move, overwrite=overwrite, checksums=checksums,
+				description=description)
+		return journal
+
+	@classmethod
+	def find(cls, directory):
+		"""Yields the journals in <directory> which nobody else has open"""
+		try:
+			names = sorted(os.listdir(directory))
+		except OSError:
+			return
+		for name in names:
+			if not name.endswith(cls.suffix):
+				continue
+			journal = cls(join(directory, name))
+			try:
+				if not journal._open():
+					continue
+				journal._load()
+			except (IOError, OSError, ValueError, KeyError):
+				journal.close()
+				continue
+			yield journal
+
+	def _open(self):
+		"""Open and lock the file, returns False if it's locked already"""
+		self._file = open(self.path, 'a+')
+		if fcntl is not None:
+			try:
+				fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except (IOError, OSError):
+				self.close()
+				return False
+		return True
+
+	def _load(self):
+		self._file.seek(0)
+		lines = self._file.read().splitlines()
+		info = json.loads(lines[0])
+		self.paths = info['paths']
+		self.target_dir = info['target_dir']
+		self.move = info['move']
+		self.overwrite = info['overwrite']
+		self.checksums = info['checksums']
+		self.description = info.get('description')
+		for line in lines[1:]:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue  # cut off by a crash
+			if 'done' in record:
+				self.done[record['done']] = (record['size'],
+						record['mtime'], record.get('checksum'))
+				self.interrupted.discard(record['done'])
+			elif 'started' in record:
+				self.interrupted.add(record['started'])
+			elif 'target' in record:
+				self.targets[record['path']] = record['target']
+			elif 'moved' in record:
+				self.moved.add(record['moved'])
+
+	def _write(self, **record):
+		line = json.dumps(record) + '\n'
+		with self._lock:
+			if self._file is None:
+				return  # closed already
+			self._file.write(line)
+			self._file.flush()
+
+	def set_target(self, path, target):
+		self.targets[path] = target
+		self._write(path=path, target=target)
+
+	def set_moved(self, path):
+		self.moved.add(path)
+		self._write(moved=path)
+
+	def set_started(self, target):
+		"""Record that <target> is being written.  Any thread may call this."""
+		self._write(started=target)
+
+	def set_done(self, target, stat, checksum=None):
+		"""Record that <target> was copied from a file with this stat"""
+		record = (stat.st_size, _mtime(stat), checksum)
+		self.done[target] = record
+		self._write(done=target, size=record[0], mtime=record[1],
+				checksum=checksum)
+
+	def is_done(self, target, stat):
+		"""
+		Was <target> copied from a file with this stat, and does it still
+		look like that?
+		"""
+		try:
+			size, mtime, checksum = self.done[target]
+			target_stat = os.lstat(target)
+		except (KeyError, OSError):
+			return False
+		if (size, mtime) != (stat.st_size, _mtime(stat)) \
+				or S_IFMT(target_stat.st_mode) != S_IFMT(stat.st_mode):
+			return False
+		if S_ISREG(stat.st_mode):
+			if (target_stat.st_size, _mtime(target_stat)) != (size, mtime):
+				return False
+			if checksum is not None and file_checksum(target) != checksum:
+				return False
+		return True
+
+	def close(self, remove=False):
+		"""Close the journal, and delete it if the transfer is over"""
+		if remove:
+			try:
+				os.remove(self.path)
+			except OSError:
+				pass
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+def _mtime(stat):
+	"""
+	The mtime of <stat> in whole microseconds, which survives the way
+	through copy_metadata.  Without st_mtime_ns (python 2), utime gets a
+	float and cuts it off somewhere below the second, so only whole
+	seconds are compared there.
+	"""
+	try:
+		return stat.st_mtime_ns // 1000
+	except AttributeError:
+		return int(stat.st_mtime) * 1000000
+
+def file_checksum(path, chunk_size=CHUNK_SIZE):
+	"""The SHA-1 checksum of the contents of a file, in hex"""
+	checksum = hashlib.sha1()
+	source = open(path, 'rb')
+	try:
+		while True:
+			data = source.read(chunk_size)
+			if not data:
+				break
+			checksum.update(data)
+	finally:
+		source.close()
+	return checksum.hexdigest()
+
+
+class Removal(object):
+	"""
+	Deletes files and directory trees.
+
+	The trees are walked first to count their files.  Then the contents of
+	each directory are deleted before the directory itself.  Files are
+	unlinked by <threads> threads at once, which helps on network file
+	systems.  Errors don't stop the removal, they are collected in the
+	errors attribute, and the directories above such files are kept.
+
+	>>> import tempfile
+	>>> tmp = tempfile.mkdtemp()
+	>>> os.makedirs(join(tmp, 'a', 'b'))
+	>>> for name in ('x', 'a/y', 'a/b/z'):
+	...     open(join(tmp, name), 'w').close()
+	>>> removal = Removal([join(tmp, 'a'), join(tmp, 'x')], threads=2)
+	>>> for _ in removal.generate(): pass
+	>>> os.listdir(tmp), removal.done_files, removal.errors
+	([], 5, [])
+	>>> os.rmdir(tmp)
+	"""
+
+	batch_size = 256  # how many files are unlinked at once
+
+	def __init__(self, paths, threads=1):
+		self.paths = list(paths)
+		self.threads = threads
+		self.planned = False  # whether total_files is known
+		self.total_files = 0
+		self.done_files = 0
+		self.errors = []  # (path, exception) tuples
+		self._failed = set()  # directories which have to stay
+
+	def generate(self):
+		"""Returns a generator which does the work, yielding now and then"""
+		def onerror(err):
+			self._error(err.filename, err)
+			self._failed.add(err.filename)
+
+		jobs = []
+		for path in self.paths:
+			for i, (name, stat) in enumerate(walk(path, onerror)):
+				jobs.append((name, S_ISDIR(stat.st_mode)))
+				self.total_files += 1
+				if i % 256 == 255:
+					yield
+		self.planned = True
+		yield
+
+		batch = []
+		for path, is_dir in reversed(jobs):
+			if not is_dir:
+				batch.append(path)
+				if len(batch) >= self.batch_size:
+					for _ in self._remove_batch(batch):
+						yield
+					batch = []
+				continue
+			for _ in self._remove_batch(batch):
+				yield
+			batch = []
+			if path in self._failed:
+				self._failed.add(dirname(path))
+				continue
+			try:
+				os.rmdir(path)
+			except OSError as err:
+				self._error(path, err)
+				continue
+			self.done_files += 1
+			yield
+		for _ in self._remove_batch(batch):
+			yield
+
+	def _remove_batch(self, batch):
+		if self.threads > 1:
+			results = parallel_map(_unlink, batch, workers=self.threads)
+		else:
+			results = (_unlink(path) for path in batch)
+		index = 0
+		for error in results:
+			if error is PENDING:
+				yield
+				continue
+			path = batch[index]
+			index += 1
+			if error is None:
+				self.done_files += 1
+			else:
+				self._error(path, error)
+			yield
+
+	def _error(self, path, error):
+		self.errors.append((path, error))
+		self._failed.add(dirname(path))
+
+class LinkTree(object):
+	"""
+	Mirrors trees of files into a directory with hard links.
+
+	Directories are created and files are hard linked.  Like cp -lL,
+	symlinks are followed: a symlinked directory is mirrored as a
+	directory, and a symlinked file is linked to its target.  Symlink
+	loops are reported as errors.  Files which are linked there already
+	are skipped.  If the name of a file is taken by
+	another file, the link gets the next free name like with
+	next_available_filename: name_, name_1, name_2 and so on.  A link
+	under one of these names counts as done, too.  The names in
+	each target directory are listed only once and then remembered.
+
+	>>> import tempfile
+	>>> tmp = tempfile.mkdtemp()
+	>>> os.makedirs(join(tmp, 'src', 'dir'))
+	>>> os.makedirs(join(tmp, 'dest', 'src'))
+	>>> for name in ('src/a', 'src/dir/b', 'dest/src/a'):
+	...     open(join(tmp, name), 'w').close()
+	>>> os.symlink(join(tmp, 'src', 'dir'), join(tmp, 'src', 'link'))
+	>>> link_tree = LinkTree([join(tmp, 'src')], join(tmp, 'dest'))
+	>>> for _ in link_tree.generate(): pass
+	>>> sorted(os.listdir(join(tmp, 'dest', 'src'))), link_tree.errors
+	(['a', 'a_', 'dir', 'link'], [])
+	>>> original = os.stat(join(tmp, 'src/dir/b'))
+	>>> os.stat(join(tmp, 'dest/src/dir/b')).st_ino == original.st_ino
+	True
+	>>> os.lstat(join(tmp, 'dest/src/link/b')).st_ino == original.st_ino
+	True
+	>>> link_tree = LinkTree([join(tmp, 'src')], join(tmp, 'dest'))
+	>>> for _ in link_tree.generate(): pass
+	>>> sorted(os.listdir(join(tmp, 'dest', 'src'))), link_tree.done_files
+	(['a', 'a_', 'dir', 'link'], 6)
+	>>> for _ in Removal([tmp]).generate(): pass
+	"""
+
+	def __init__(self, paths, target_dir):
+		self.paths = list(paths)
+		self.target_dir = target_dir
+		self.planned = False  # whether total_files is known
+		self.total_files = 0
+		self.done_files = 0
+		self.errors = []  # (path, exception) tuples
+		self._names = {}  # target directory -> set of the names in it
+
+	def generate(self):
+		"""Returns a generator which does the work, yielding now and then"""
+		onerror = lambda err: self.errors.append((err.filename, err))
+		jobs = []
+		for path in self.paths:
+			target = join(self.target_dir, basename(path))
+			offset = len(path)
+			for i, (name, stat) in enumerate(walk(path, onerror,
+					follow_links=True)):
+				jobs.append((name, target + name[offset:], stat))
+				self.total_files += 1
+				if i % 256 == 255:
+					yield
+		self.planned = True
+		yield
+
+		failed = set()  # directories which couldn't be created
+		for path, target, stat in jobs:
+			if dirname(path) in failed:
+				failed.add(path)
+				continue
+			try:
+				self._link(path, target, stat)
+			except OSError as err:
+				self.errors.append((path, err))
+				if S_ISDIR(stat.st_mode):
+					failed.add(path)
+				continue
+			self.done_files += 1
+			yield
+
+	def _link(self, path, target, stat):
+		directory, name = split(target)
+		names = self._names_in(directory)
+		if S_ISDIR(stat.st_mode):
+			if name in names:
+				if not isdir(target):
+					raise OSError(EEXIST, "Can't create the directory", target)
+				return
+			os.mkdir(target, S_IMODE(stat.st_mode))
+			names.add(name)
+			self._names[target] = set()
+			return
+		for name in _candidate_names(name):
+			if name not in names:
+				break
+			try:
+				existing = os.lstat(join(directory, name))
+			except OSError:
+				continue
+			if (existing.st_dev, existing.st_ino) \
+					== (stat.st_dev, stat.st_ino):
+				return
+		target = join(directory, name)
+		os.link(path, target)  # follows symlinks, like cp -lL
+		names.add(name)
+
+	def _names_in(self, directory):
+		try:
+			return self._names[directory]
+		except KeyError:
+			names = self._names[directory] = set(os.listdir(directory))
+			return names
+
+def _candidate_names(name):
+	"""The names which next_available_filename tries, in order"""
+	yield name
+	if not name.endswith('_'):
+		name += '_'
+		yield name
+	number = 1
+	while True:
+		yield name + str(number)
+		number += 1
+
+def _unlink(path):
+	try:
+		os.unlink(path)
+	except OSError as err:
+		return err
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,140 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+import os
+from os.path import join
+from stat import S_ISDIR, S_ISLNK
+try:
+	from os import scandir
+except ImportError:
+	scandir = None
+
+class TreeSize(object):
+	"""
+	Calculates the summed up size of the files in directory trees.
+
+	Files with several hard links are counted once.  The sizes of the files
+	in each directory are remembered along with the inode and mtime of the
+	directory.  Calculating the size again, or the size of a parent
+	directory, only lists the directories which changed since.  Note that
+	the mtime of a directory doesn't change when a file in it grows, so
+	pass fresh=True to generate() to list every directory again.
+
+	>>> import tempfile, shutil
+	>>> tmp = tempfile.mkdtemp()
+	>>> os.mkdir(join(tmp, 'sub'))
+	>>> def write(name, size):
+	...     f = open(join(tmp, name), 'w')
+	...     f.write('x' * size)
+	...     f.close()
+	>>> write('a', 10)
+	>>> write('sub/b', 100)
+	>>> os.link(join(tmp, 'sub/b'), join(tmp, 'c'))
+	>>> tree_size = TreeSize()
+	>>> list(tree_size.generate(tmp))[-1]
+	(110, 2)
+	>>> list(tree_size.generate(join(tmp, 'sub')))[-1]
+	(100, 1)
+	>>> write('a', 20)
+	>>> list(tree_size.generate(tmp, fresh=True))[-1]
+	(120, 2)
+	>>> shutil.rmtree(tmp)
+	"""
+
+	# Forget everything when remembering more directories than this
+	max_directories = 100000
+
+	def __init__(self):
+		self.directories = {}  # path -> ((dev, inode, mtime), info)
+
+	def generate(self, path, fresh=False):
+		"""
+		Returns a generator which calculates the size of the tree at <path>.
+		It yields the running totals as (size, number of files) tuples,
+		the last one is the result.  With <fresh>, remembered sizes are
+		not used, but the new ones are remembered.
+		"""
+		size = files = 0
+		linked = {}  # (dev, inode) -> size of files with several links
+		linked_size = 0
+		stack = [path]
+		while stack:
+			dirpath = stack.pop()
+			try:
+				dir_stat = os.stat(dirpath)
+			except OSError:
+				continue
+			key = (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime)
+			remembered = self.directories.get(dirpath)
+			if not fresh and remembered is not None and remembered[0] == key:
+				info = remembered[1]
+			else:
+				info = None
+				for info in self._scan(dirpath):
+					if info is None:
+						yield size + linked_size, files + len(linked)
+				if len(self.directories) >= self.max_directories:
+					self.directories.clear()
+				self.directories[dirpath] = (key, info)
+
+			own_size, own_files, own_linked, subdirs = info
+			size += own_size
+			files += own_files
+			for inode, inode_size in own_linked.items():
+				if inode not in linked:
+					linked[inode] = inode_size
+					linked_size += inode_size
+			stack.extend(join(dirpath, name) for name in subdirs)
+			yield size + linked_size, files + len(linked)
+		yield size + linked_size, files + len(linked)
+
+	@staticmethod
+	def _scan(dirpath):
+		"""
+		Yields None now and then while stat'ing the files in <dirpath>
+		and finally a tuple of their size, their number, a dict of the
+		files with several links and the names of the subdirectories.
+		Like os.walk, symlinks to directories are neither counted nor
+		followed.
+		"""
+		size = files = 0
+		linked = {}
+		subdirs = []
+		try:
+			if scandir is None:
+				entries = os.listdir(dirpath)
+			else:
+				entries = scandir(dirpath)
+		except OSError:
+			entries = ()
+		for i, entry in enumerate(entries):
+			if i % 256 == 255:
+				yield None
+			try:
+				if scandir is None:
+					path = join(dirpath, entry)
+					stat = os.lstat(path)
+					if S_ISDIR(stat.st_mode):
+						subdirs.append(entry)
+						continue
+					if S_ISLNK(stat.st_mode):
+						stat = os.stat(path)
+				else:
+					if entry.is_dir(follow_symlinks=False):
+						subdirs.append(entry.name)
+						continue
+					stat = entry.stat()
+			except OSError:
+				continue
+			if S_ISDIR(stat.st_mode):
+				continue
+			if stat.st_nlink > 1:
+				linked[(stat.st_dev, stat.st_ino)] = stat.st_size
+			else:
+				size += stat.st_size
+				files += 1
+		yield size, files, linked, tuple(subdirs)
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
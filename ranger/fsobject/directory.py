@@ -3,17 +3,32 @@
 
 import os.path
 from os import stat as os_stat, lstat as os_lstat
-from collections import deque
+try:
+	from os import scandir
+except ImportError:
+	scandir = None
+from array import array
 from time import time
 
 from ranger.fsobject import BAD_INFO
-from ranger.core.loader import Loadable
-from ranger.ext.mount_path import mount_path
+from ranger.core.loader import Loadable, PRIORITY_DIRECTORY
+from ranger.ext.mount_path import mount_info
 from ranger.fsobject import File, FileSystemObject
+from ranger.fsobject.fsobject import natural_key
+from ranger.fsobject.filelist import FileList
 from ranger.core.shared import SettingsAware
 from ranger.ext.accumulator import Accumulator
 from ranger.ext.lazy_property import lazy_property
 from ranger.ext.human_readable import human_readable
+from ranger.ext.parallel_map import parallel_map, PENDING
+from ranger.ext.tree_size import TreeSize
+from ranger.ext.search_index import SearchIndex
+from ranger.container.markeditems import MarkedItems
+from ranger.container.listingcache import MIN_FILES as MIN_CACHED_FILES, \
+		CachedEntry, HAS_STAT, IS_DIR, IS_LINK
+
+# How many sort keys the order of the files is remembered for
+SORT_ORDERS_CACHED = 3
 
 def sort_by_basename(path):
 	"""returns path.basename (for sorting)"""
@@ -45,21 +60,66 @@ def accept_file(fname, dirname, hidden_filter, name_filter):
 		return False
 	return True
 
+class CumulativeSizeLoader(Loadable):
+	"""
+	Calculates the size of a directory tree on a thread of the loader.
+	The result is applied to the directory in finish().
+	"""
+	threaded = True
+
+	def __init__(self, directory, fresh=False):
+		Loadable.__init__(self, None,
+				"Calculating the size of " + directory.path)
+		self.directory = directory
+		self.fresh = fresh
+		self.size = 0
+		self.load_generator = self._generate()
+
+	def _generate(self):
+		path = self.directory.path
+		for size, count in self.directory.tree_size.generate(path,
+				fresh=self.fresh):
+			self.size = size
+			self.description = "Calculating the size of %s: %s in %d " \
+					"files" % (path, human_readable(size, separator=''), count)
+			yield
+
+	def cancel(self):
+		if self.directory.cumulative_size_loader is self:
+			self.directory.cumulative_size_loader = None
+
+	def finish(self):
+		self.directory._set_cumulative_size(self, self.size)
+
 class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 	is_directory = True
+	priority = PRIORITY_DIRECTORY
 	enterable = False
 	load_generator = None
 	cycle_list = None
+	_cycle_position = 0
 	loading = False
 
 	filenames = None
 	files = None
 	filter = None
+
+	# All loaded files, including the ones which are hidden by a filter.
+	# Not used for a FileList, which keeps the hidden files as records
+	# missing from its order.
+	files_all = None
+	_filters = None  # the filters which were applied to files
+	_search_index = None  # for the current order of the files
+	_orderings = None  # cycle order -> paths, see get_ordering()
 	marked_items = None
+	_path_index = None  # (filenames, set of filenames), see _has_path()
 	scroll_begin = 0
 
 	mount_path = '/'
-	disk_usage = 0
+	mount_type = None  # the file system type, if known
+	background_stat = None
+	_pending_listing = None  # arguments for the listing cache, see load
+	_disk_usage = None
 
 	last_update_time = -1
 	load_content_mtime = -1
@@ -68,7 +128,44 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 	content_outdated = False
 	content_loaded = False
 
+	# Set by the DirectoryWatcher.  Watched directories are not polled for
+	# changes of their mtime, instead the watcher calls request_reload() or
+	# request_partial_reload() when something changes.
+	watched = False
+	_changed_names = None
+
+	# (sort key, order) pairs, see sort()
+	_sort_orders = ()
+
+	# True if the current listing was taken from the listing cache and the
+	# files were not checked yet
+	loaded_from_cache = False
+
 	_cumulative_size_calculated = False
+	cumulative_size_loader = None
+
+	# Shared by all directories, so they reuse each other's results
+	tree_size = TreeSize()
+
+	# Estimated memory usage of a file object and of a record in a FileList,
+	# in bytes, see memory_usage()
+	memory_per_file = 2048
+	memory_per_record = 224
+
+	# size and infostring describe the content, not the stat
+	lazy_stat_attributes = ('stat', 'accessible', 'exists')
+
+	# Sorting by these needs the stat of every file
+	stat_sorts = ('size', 'mtime', 'ctime', 'atime')
+
+	# The orders for cycling through the files with search_next
+	cycle_dict = {
+		'size': lambda item: -item.size,
+		'mimetype': lambda item: item.mimetype or '',
+		'ctime': lambda item: -int(item.stat and item.stat.st_ctime),
+		'atime': lambda item: -int(item.stat and item.stat.st_atime),
+		'mtime': lambda item: -int(item.stat and item.stat.st_mtime),
+	}
 
 	sort_dict = {
 		'basename': sort_by_basename,
@@ -86,16 +183,17 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 		Accumulator.__init__(self)
 		FileSystemObject.__init__(self, path, **kw)
 
-		self.marked_items = list()
+		self.marked_items = MarkedItems()
 
 		for opt in ('sort_directories_first', 'sort', 'sort_reverse',
 				'sort_case_insensitive'):
 			self.settings.signal_bind('setopt.' + opt,
 					self.request_resort, weak=True, autosort=False)
 
+		# With a low priority, so the new value is set already
 		for opt in ('hidden_filter', 'show_hidden'):
 			self.settings.signal_bind('setopt.' + opt,
-				self.request_reload, weak=True, autosort=False)
+				self.refilter, priority=0.1, weak=True, autosort=False)
 		self.use()
 
 	def request_resort(self):
@@ -103,21 +201,86 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 
 	def request_reload(self):
 		self.content_outdated = True
+		self._changed_names = None
+
+	def request_partial_reload(self, name):
+		"""Request a reload which only needs to reload the file <name>"""
+		self.content_outdated = True
+		if self._changed_names is not None:
+			self._changed_names.add(name)
 
 	def get_list(self):
 		return self.files
 
+	def _get_filters(self):
+		hidden_filter = not self.settings.show_hidden \
+				and self.settings.hidden_filter
+		return hidden_filter, self.filter
+
+	def _filter_func(self, filters):
+		"""Returns a function which tells whether a basename is shown"""
+		path = self.path
+		hidden_filter, name_filter = filters
+		return lambda name: accept_file(name, path, hidden_filter, name_filter)
+
+	def refilter(self):
+		"""
+		Apply the filters to the loaded files again, without reloading.
+		If only the name filter got longer, just the files which are
+		displayed at the moment are checked.
+		"""
+		if self.loading:
+			# The filters were read already when the loading started
+			self.request_reload()
+			return
+		if self.files is None or not self.content_loaded:
+			return
+
+		filters = self._get_filters()
+		old_hidden_filter, old_name_filter = self._filters
+		narrowing = filters[0] == old_hidden_filter and \
+				(old_name_filter or '') in (filters[1] or '')
+		accept = self._filter_func(filters)
+		files = self.files
+		if isinstance(files, FileList):
+			if narrowing:
+				records = files.order
+			else:
+				records = range(len(files.paths))
+			files.order = array('L', [record for record in records
+					if accept(files.basename(record))])
+			self.filenames = [files.paths[record] for record in files.order]
+		else:
+			candidates = files if narrowing else self.files_all
+			files = [item for item in candidates if accept(item.basename)]
+			self.filenames = [item.path for item in files]
+			self.files = files
+		self._filters = filters
+		self._forget_sort_orders()
+		self._search_index = None
+		self._orderings = None
+		self._disk_usage = None
+		self._gc_marked_items()
+
+		# Narrowing keeps the order
+		if not narrowing:
+			self.sort()
+		self.cycle_list = None
+		if files:
+			if self.pointed_obj is not None:
+				self.sync_index()
+			else:
+				self.move(to=0)
+		self.correct_pointer()
+		self.last_update_time = time()
+
 	def mark_item(self, item, val):
 		item._mark(val)
 		if val:
-			if item in self.files and not item in self.marked_items:
-				self.marked_items.append(item)
+			if self._has_path(item.path):
+				self.marked_items.add(item)
 		else:
-			while True:
-				try:
-					self.marked_items.remove(item)
-				except ValueError:
-					break
+			self.marked_items.discard(item)
 
 	def toggle_mark(self, item):
 		self.mark_item(item, not item.marked)
@@ -127,29 +290,38 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 			self.toggle_mark(item)
 
 	def mark_all(self, val):
-		for item in self.files:
-			self.mark_item(item, val)
-
-		if not val:
-			del self.marked_items[:]
+		if val:
+			for item in self.files:
+				self.mark_item(item, val)
+		else:
 			self._clear_marked_items()
 
-	# XXX: Is it really necessary to have the marked items in a list?
-	# Can't we just recalculate them with [f for f in self.files if f.marked]?
+	def _has_path(self, path):
+		"""Whether one of the files has this path, in constant time"""
+		filenames = self.filenames
+		if filenames is None:
+			return False
+		if self._path_index is None or self._path_index[0] is not filenames:
+			self._path_index = (filenames, set(filenames))
+		return path in self._path_index[1]
+
 	def _gc_marked_items(self):
-		for item in list(self.marked_items):
-			if item.path not in self.filenames:
-				self.marked_items.remove(item)
+		for item in self.marked_items:
+			if not self._has_path(item.path):
+				item._mark(False)
+				self.marked_items.discard(item)
 
 	def _clear_marked_items(self):
 		for item in self.marked_items:
 			item._mark(False)
-		del self.marked_items[:]
+		self.marked_items.clear()
 
 	def get_selection(self):
 		"""READ ONLY"""
 		self._gc_marked_items()
 		if self.marked_items:
+			if isinstance(self.files, FileList):
+				return sorted(self.marked_items, key=self.files.index)
 			return [item for item in self.files if item.marked]
 		elif self.pointed_obj:
 			return [self.pointed_obj]
@@ -171,11 +343,44 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 				yield
 				mypath = self.path
 
-				self.mount_path = mount_path(mypath)
-
-				hidden_filter = not self.settings.show_hidden \
-						and self.settings.hidden_filter
-				filelist = os.listdir(mypath)
+				self.mount_path, self.mount_type = mount_info(mypath)
+
+				filters = self._get_filters()
+				accept = self._filter_func(filters)
+
+				# If the directory is watched, remember which files change
+				# from now on.  Otherwise every file needs to be checked.
+				changed_names = self._changed_names if self.watched else None
+				self._changed_names = set()
+
+				# The stats of a cached listing may be outdated, so the
+				# files are checked by reloading once it is displayed.
+				check_cached_files = self.loaded_from_cache
+				if check_cached_files:
+					changed_names = None
+				self.loaded_from_cache = False
+
+				# The listing is cached before filtering
+				listing_cache = self._get_listing_cache()
+				filter_key = ''
+				cached = None
+				if listing_cache is not None and not self.content_loaded:
+					cached = listing_cache.get(mypath, filter_key)
+
+				if cached is not None:
+					total, entries = cached
+					entries = [(entry.path, entry) for entry in entries]
+					self.loaded_from_cache = True
+				else:
+					if scandir is None:
+						entries = [(fname, None)
+								for fname in os.listdir(mypath)]
+					else:
+						entries = [(entry.name, entry)
+								for entry in scandir(mypath)]
+					total = len(entries)
+					entries = [(mypath + (mypath == '/' and fname or
+							'/' + fname), entry) for fname, entry in entries]
 
 				if self._cumulative_size_calculated:
 					# If self.content_loaded is true, this is not the first
@@ -190,62 +395,211 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 					else:
 						self.infostring = ' %s' % human_readable(self.size)
 				else:
-					self.size = len(filelist)
+					self.size = total
 					self.infostring = ' %d' % self.size
 				if self.is_link:
 					self.infostring = '->' + self.infostring
 
-				filenames = [mypath + (mypath == '/' and fname or '/' + fname)\
-						for fname in filelist if accept_file(
-							fname, mypath, hidden_filter, self.filter)]
+				filenames = [name for name, entry in entries]
 				yield
 
 				self.load_content_mtime = os.stat(mypath).st_mtime
 
-				marked_paths = [obj.path for obj in self.marked_items]
+				marked_paths = self.marked_items.paths()
 
-				files = []
-				disk_usage = 0
-				for name in filenames:
-					try:
-						file_lstat = os_lstat(name)
-						if file_lstat.st_mode & 0o170000 == 0o120000:
-							file_stat = os_stat(name)
-						else:
-							file_stat = file_lstat
-						stats = (file_stat, file_lstat)
-						is_a_dir = file_stat.st_mode & 0o170000 == 0o040000
-					except:
-						stats = None
-						is_a_dir = False
-					if is_a_dir:
-						try:
-							item = self.fm.env.get_directory(name)
+				# Files loaded from a DirEntry are only stat'ed when needed.
+				# Do it right away if the sorting or the status bar (which
+				# shows the disk usage of the current directory) needs it.
+				try:
+					stat_eagerly = self.settings.sort in self.stat_sorts \
+							or self is self.fm.env.cwd
+				except:
+					stat_eagerly = True
+
+				# Display huge directories before stat'ing the files.  The
+				# visible ones get stat'ed when drawing, the others later.
+				threshold = self.settings.background_stat_threshold
+				stat_in_background = stat_eagerly and scandir is not None \
+						and threshold is not None and len(filenames) > threshold
+				if stat_in_background:
+					stat_eagerly = False
+
+				# Huge directories are stored in arrays.  The objects for the
+				# files are only created when they're needed.
+				compact_threshold = self.settings.compact_threshold
+				compact = compact_threshold is not None and entries \
+						and entries[0][1] is not None \
+						and len(entries) > compact_threshold
+				if compact:
+					if stat_eagerly or stat_in_background:
+						stat_in_background = True
+						stat_eagerly = False
+					files = FileList(mypath, self._make_item)
+					for i, (name, entry) in enumerate(entries):
+						files.append_entry(name, entry)
+						if i % 1000 == 999:
+							yield
+					files.order = array('L', [record
+							for record in range(len(files.paths))
+							if accept(files.basename(record))])
+					filenames = [files.paths[record] for record in files.order]
+					files_all = None
+					sort_needed = True
+					self._disk_usage = None
+				else:
+					# When reloading, keep the objects of files which are still
+					# there (along with their marks, previews and cached
+					# properties) and only load the new or replaced ones.
+					kept = set()
+					if self.files_all is not None and self.content_loaded:
+						old_files = dict((item.path, item)
+								for item in self.files_all)
+						new_entries = []
+						for name, entry in entries:
+							item = old_files.get(name)
+							if item is None:
+								reusable = False
+							elif check_cached_files and entry is not None:
+								# Take the fresh stat from the new DirEntry
+								reusable = self._is_reusable(item, entry) \
+										and item._defer_stat(entry)
+							elif changed_names is None:
+								reusable = self._is_reusable(item, entry)
+							else:
+								reusable = item.basename not in changed_names
+							if reusable:
+								kept.add(item)
+								# A file which changed in place may need to
+								# move when sorting by its stat
+								if entry is not None \
+										and item._dir_entry is entry \
+										and self.settings.sort \
+										in self.stat_sorts:
+									self.order_outdated = True
+							else:
+								new_entries.append((name, entry))
+						entries = new_entries
+
+					for item in kept:
+						if scandir is None and changed_names is None:
 							item.load_if_outdated()
-						except:
-							item = Directory(name, preload=stats,
-									path_is_abs=True)
+						if stat_eagerly:
+							item.load_stat()
+						yield
+
+					# On network filesystems, each stat waits for a round trip.
+					# Stat many files at once there.
+					stat_threads = self.get_stat_threads()
+					if stat_threads > 1 and (stat_eagerly or scandir is None):
+						stat_results = parallel_map(self._stat_file,
+								[name for name, entry in entries],
+								workers=stat_threads)
+					else:
+						stat_results = None
+
+					new_files = []
+					for name, entry in entries:
+						if stat_results is not None:
+							result = next(stat_results)
+							while result is PENDING:
+								yield
+								result = next(stat_results)
+							stats, is_a_dir = result
+						elif entry is None:
+							stats, is_a_dir = self._stat_file(name)
+						else:
+							stats = entry
+							try:
+								is_a_dir = entry.is_dir()
+							except OSError:
+								is_a_dir = False
+						if is_a_dir:
+							try:
+								item = self.fm.env.get_directory(name)
+								if stats is None:
+									item.load_if_outdated()
+								else:
+									item.preload = stats
+									item.load()
+							except:
+								item = Directory(name, preload=stats,
+										path_is_abs=True)
+								item.load()
+						else:
+							item = File(name, preload=stats, path_is_abs=True)
 							item.load()
+						if stat_eagerly:
+							item.load_stat()
+						new_files.append(item)
+						yield
+					self._disk_usage = None
+
+					files_all = list(kept)
+					files_all.extend(new_files)
+
+					if kept and filters == self._filters:
+						files = [item for item in self.files if item in kept]
+						new_files = [item for item in new_files
+								if accept(item.basename)]
+
+						# Insert the new files into the already sorted list
+						# unless it's faster to sort everything again
+						if not self.order_outdated \
+								and len(new_files) < len(files) // 8:
+							for item in new_files:
+								self._insort(files, item)
+							sort_needed = False
+						else:
+							files.extend(new_files)
+							sort_needed = True
 					else:
-						item = File(name, preload=stats, path_is_abs=True)
-						item.load()
-						disk_usage += item.size
-					files.append(item)
-					yield
-				self.disk_usage = disk_usage
+						files = [item for item in files_all
+								if accept(item.basename)]
+						sort_needed = True
+					filenames = [item.path for item in files]
 
 				self.filenames = filenames
 				self.files = files
+				self.files_all = files_all
+				self._filters = filters
+				self._forget_sort_orders()
+				self._search_index = None
+				self._orderings = None
 
 				self._clear_marked_items()
-				for item in self.files:
-					if item.path in marked_paths:
+				if compact:
+					for path in marked_paths:
+						try:
+							item = files[files.index_path(path)]
+						except ValueError:
+							continue
 						item._mark(True)
-						self.marked_items.append(item)
-					else:
-						item._mark(False)
-
-				self.sort()
+						self.marked_items.add(item)
+				else:
+					for item in self.files:
+						if item.path in marked_paths:
+							item._mark(True)
+							self.marked_items.add(item)
+						else:
+							item._mark(False)
+
+				if stat_in_background:
+					self._stat_in_background()
+
+				# The listing is cached once the files are stat'ed, so the
+				# cache holds their stats as well
+				self._pending_listing = None
+				if self.loaded_from_cache:
+					self.request_reload()
+				elif listing_cache is not None and not self.content_loaded \
+						and len(files) >= MIN_CACHED_FILES:
+					self._pending_listing = (listing_cache, filter_key, total)
+					if self.background_stat is None:
+						self._store_pending_listing()
+
+				if sort_needed:
+					self.order_outdated = False
+					self.sort()
 
 				if files:
 					if self.pointed_obj is not None:
@@ -255,6 +609,7 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 			else:
 				self.filenames = None
 				self.files = None
+				self.files_all = None
 
 			self.cycle_list = None
 			self.content_loaded = True
@@ -265,18 +620,274 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 			self.loading = False
 			self.fm.signal_emit("finished_loading_dir", directory=self)
 
+	def _make_item(self, path, flags, mode, inode, stat):
+		"""Create the FileSystemObject for a record of a FileList"""
+		entry = CachedEntry(path, path[path.rindex('/') + 1:], flags, mode,
+				inode, stat)
+		if flags & IS_DIR:
+			try:
+				item = self.fm.env.get_directory(path)
+				item.preload = entry
+				item.load()
+			except:
+				item = Directory(path, preload=entry, path_is_abs=True)
+				item.load()
+		else:
+			item = File(path, preload=entry, path_is_abs=True)
+			item.load()
+		return item
+
+	def _stat_in_background(self):
+		"""Stat the files which were not stat'ed while loading"""
+		if self.background_stat is not None:
+			self.fm.loader.remove(self.background_stat)
+		loadable = Loadable(None, "Getting file information in " + self.path)
+		if isinstance(self.files, FileList):
+			loadable.load_generator = self._generate_record_stats(loadable,
+					self.files)
+		else:
+			files = [item for item in self.files
+					if item._dir_entry is not None]
+			loadable.load_generator = self._generate_stats(loadable, files)
+		self.background_stat = loadable
+		self.fm.loader.add(loadable, append=True)
+
+	def stat_remaining_files(self):
+		"""
+		Stat the records of a FileList in the background which were not
+		stat'ed while loading, because nothing needed their stat back then
+		"""
+		if self.background_stat is None and not self.loading \
+				and isinstance(self.files, FileList) \
+				and not self.files.has_all_stats():
+			self._stat_in_background()
+
+	def _get_listing_cache(self):
+		size = self.settings.listing_cache_size
+		try:
+			listing_cache = self.fm.listing_cache
+		except AttributeError:
+			return None
+		if listing_cache is None or size is None:
+			return None
+		listing_cache.max_size = size
+		return listing_cache
+
+	def _store_pending_listing(self):
+		"""
+		Save the listing in the listing cache.  The records are taken
+		here on the main thread, the thread which writes them only gets
+		plain data.
+		"""
+		listing_cache, filter_key, total = self._pending_listing
+		self._pending_listing = None
+		files = self.files if self.files_all is None else self.files_all
+		if files is None:
+			return
+		loadable = Loadable(listing_cache.store(self.path, filter_key,
+				total, self._listing_records(files)),
+				"Caching listing of " + self.path)
+		loadable.threaded = True
+		self.fm.loader.add(loadable, append=True)
+
+	@staticmethod
+	def _listing_records(files):
+		"""
+		Returns an iterable of (name, flags, mode, inode, stat) tuples for
+		the listing cache.  A FileList is copied, which is quicker than
+		building the tuples, so that happens on the thread.
+		"""
+		if isinstance(files, FileList):
+			files = files.copy()
+			return ((files.basename(record), files.flags[record],
+					files.modes[record], files.inodes[record],
+					files.stat(record)) for record in range(len(files.paths)))
+		records = []
+		for item in files:
+			flags = IS_DIR if item.is_directory else 0
+			if item.is_link:
+				flags |= IS_LINK
+			mode = 0o040000 if item.is_directory else 0o100000
+			entry = item._dir_entry
+			if entry is None:
+				stat = item.stat
+				inode = stat.st_ino if stat and not item.is_link else 0
+				records.append((item.basename, flags, mode, inode, stat))
+			else:
+				try:
+					inode = entry.inode()
+				except OSError:
+					inode = 0
+				records.append((item.basename, flags, mode, inode, None))
+		return records
+
+	def _generate_stats(self, loadable, files):
+		refine = self.settings.sort in self.stat_sorts
+		next_refine = 1024
+		stat_threads = self.get_stat_threads()
+		if stat_threads > 1:
+			# DirEntry objects cache their stat, so let the threads
+			# fill the cache and do the rest in this thread.
+			def prefetch(item):
+				try:
+					item._dir_entry.stat(follow_symlinks=False)
+				except (OSError, AttributeError):
+					pass
+			prefetched = parallel_map(prefetch, files, workers=stat_threads)
+		else:
+			prefetched = None
+		try:
+			for i, item in enumerate(files):
+				if prefetched is not None:
+					while next(prefetched) is PENDING:
+						yield
+				item.load_stat()
+				if refine and i == next_refine:
+					next_refine *= 2
+					self.sort()
+					self.last_update_time = time()
+				yield
+		finally:
+			if self.background_stat is loadable:
+				self.background_stat = None
+		self._disk_usage = None
+		if refine:
+			self.sort()
+		self.last_update_time = time()
+		if self._pending_listing is not None:
+			self._store_pending_listing()
+
+	def _generate_record_stats(self, loadable, files):
+		refine = self.settings.sort in self.stat_sorts
+		next_refine = 1024
+		records = [record for record in range(len(files.paths))
+				if not files.has_stat(record)]
+		paths = [files.paths[record] for record in records]
+		stat_threads = self.get_stat_threads()
+		if stat_threads > 1:
+			results = parallel_map(self._stat_file, paths,
+					workers=stat_threads)
+		else:
+			results = (self._stat_file(path) for path in paths)
+		try:
+			for i, record in enumerate(records):
+				result = next(results)
+				while result is PENDING:
+					yield
+					result = next(results)
+				stats = result[0]
+				files.set_stat(record, stats and stats[0])
+				if refine and i == next_refine:
+					next_refine *= 2
+					self.sort()
+					self.last_update_time = time()
+				if i % 64 == 63:
+					yield
+		finally:
+			if self.background_stat is loadable:
+				self.background_stat = None
+		self._disk_usage = None
+		if refine:
+			self.sort()
+		self.last_update_time = time()
+		if self._pending_listing is not None:
+			self._store_pending_listing()
+
+	def get_stat_threads(self):
+		"""The number of threads for stat'ing or deleting files in here"""
+		stat_threads = self.settings.stat_threads
+		try:
+			return stat_threads[self.mount_path]
+		except KeyError:
+			return stat_threads.get(self.mount_type, 0)
+
+	@staticmethod
+	def _is_reusable(item, entry):
+		"""
+		Can the FileSystemObject <item> of the previous listing be kept for
+		the new listing?  Without a DirEntry, this is always true since
+		load_if_outdated() will take care of changes.  Otherwise the file
+		must have the same inode.  If it was stat'ed already and changed
+		in place since then, the item takes the new stat from the DirEntry.
+		"""
+		if entry is None:
+			return True
+		try:
+			if item._dir_entry is not None:
+				# Not stat'ed yet, so the new DirEntry can take its place
+				# without a syscall
+				return item._dir_entry.inode() == entry.inode() \
+						and item._defer_stat(entry)
+			old_stat = item.stat
+			if not old_stat or item.is_link:
+				return False
+			new_stat = entry.stat(follow_symlinks=False)
+			if new_stat.st_ino != old_stat.st_ino:
+				return False
+			if new_stat.st_ctime != old_stat.st_ctime \
+					or new_stat.st_mtime != old_stat.st_mtime \
+					or new_stat.st_size != old_stat.st_size:
+				return item._defer_stat(entry)
+			return True
+		except OSError:
+			return False
+
+	@staticmethod
+	def _stat_file(path):
+		"""
+		Returns a (stat, lstat) tuple for the preload argument of
+		FileSystemObjects and whether <path> points to a directory
+		"""
+		try:
+			file_lstat = os_lstat(path)
+			if file_lstat.st_mode & 0o170000 == 0o120000:
+				file_stat = os_stat(path)
+			else:
+				file_stat = file_lstat
+			return (file_stat, file_lstat), \
+					file_stat.st_mode & 0o170000 == 0o040000
+		except:
+			return None, False
+
 	def unload(self):
 		self.loading = False
 		self.load_generator = None
 
+	def memory_usage(self):
+		"""Estimate how much memory the loaded files take, in bytes"""
+		files = self.files
+		if files is None:
+			return 0
+		if isinstance(files, FileList):
+			return len(files) * self.memory_per_record + \
+					files.count_items() * self.memory_per_file
+		return len(files) * self.memory_per_file
+
+	def unload_content(self):
+		"""
+		Forget the loaded files to free memory.  The directory keeps its
+		cursor position and loads the files again when they are needed.
+		"""
+		self.files = None
+		self.files_all = None
+		self.filenames = None
+		self._path_index = None
+		self._search_index = None
+		self._orderings = None
+		self._pending_listing = None
+		self.marked_items = MarkedItems()
+		self._forget_sort_orders()
+		self.content_loaded = False
+		self.load_content_mtime = -1
+
 	def load_content(self, schedule=None):
 		"""
 		Loads the contents of the directory. Use this sparingly since
 		it takes rather long.
 		"""
-		self.content_outdated = False
-
 		if not self.loading:
+			self.content_outdated = False
+
 			if not self.loaded:
 				self.load()
 
@@ -303,12 +914,8 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 				self.load_generator = None
 
 
-	def sort(self):
-		"""Sort the containing files"""
-		if self.files is None:
-			return
-
-		old_pointed_obj = self.pointed_obj
+	def _get_sort_func(self):
+		"""Returns the key function for the current sort settings"""
 		try:
 			sort_func = self.sort_dict[self.settings.sort]
 		except:
@@ -322,64 +929,287 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 				sort_func == sort_naturally:
 			sort_func = sort_naturally_icase
 
-		self.files.sort(key = sort_func)
+		return sort_func
 
-		if self.settings.sort_reverse:
-			self.files.reverse()
+	def sort(self):
+		"""Sort the containing files"""
+		if self.files is None:
+			return
+
+		old_pointed_obj = self.pointed_obj
+		files = self.files
+		compact = isinstance(files, FileList)
+
+		# Files without stat data are sorted by name and kept at the end
+		# until their stat arrives.
+		pending = self.background_stat is not None \
+				and self.settings.sort in self.stat_sorts
+
+		# The order before reversing and putting directories first is
+		# cached for the recent sort keys, along with the same order split
+		# into directories and other files.  Toggling these options or
+		# switching back to one of these sort keys needs no sorting then.
+		mode = (self.settings.sort, self.settings.sort_case_insensitive)
+		cached = None if pending else self._get_cached_order(mode)
+		if cached is None:
+			cached = [self._sorted_order(files, pending), None]
+			if not pending:
+				self._cache_order(mode, cached)
+		order, split = cached
 
 		if self.settings.sort_directories_first:
-			self.files.sort(key = sort_by_directory)
+			if split is None:
+				split = cached[1] = self._split_directories(files, order)
+			directories, others = split
+			if self.settings.sort_reverse:
+				order = directories[::-1] + others[::-1]
+			else:
+				order = directories + others
+		elif self.settings.sort_reverse:
+			order = order[::-1]
+
+		if compact:
+			files.order = array('L', order)
+		else:
+			files[:] = order
+		self._search_index = None
 
 		if self.pointer is not None:
 			self.move_to_obj(old_pointed_obj)
 		else:
 			self.correct_pointer()
 
-	def _get_cumulative_size(self):
-		if self.size == 0:
-			return 0
-		cum = 0
-		realpath = os.path.realpath
-		for dirpath, dirnames, filenames in os.walk(self.path,
-				onerror=lambda _: None):
-			for file in filenames:
-				try:
-					if dirpath == self.path:
-						stat = os_stat(realpath(dirpath + "/" + file))
-					else:
-						stat = os_stat(dirpath + "/" + file)
-					cum += stat.st_size
-				except:
-					pass
-		return cum
+	def _get_cached_order(self, mode):
+		for cached_mode, order in self._sort_orders:
+			if cached_mode == mode:
+				return order
+		return None
+
+	def _cache_order(self, mode, order):
+		self._sort_orders = [item for item in self._sort_orders
+				if item[0] != mode][1 - SORT_ORDERS_CACHED:] + [(mode, order)]
+
+	def _forget_sort_orders(self):
+		self._sort_orders = ()
+
+	@staticmethod
+	def _split_directories(files, order):
+		"""Split the order into the directories and the other files"""
+		if isinstance(files, FileList):
+			is_dir = files.is_dir
+			return array('L', [record for record in order if is_dir(record)]), \
+					array('L', [record for record in order
+						if not is_dir(record)])
+		return [item for item in order if item.is_directory], \
+				[item for item in order if not item.is_directory]
+
+	def _sorted_order(self, files, pending):
+		"""
+		Returns the files sorted by the current sort key, not reversed.
+		For a FileList, the records are sorted, and where possible, the
+		keys are taken from the records to avoid creating the objects.
+		"""
+		sort_func = self._get_sort_func()
+		if isinstance(files, FileList):
+			key = self._get_record_sort_func(files)
+			if key is None:
+				key = lambda record: sort_func(files.item(record))
+			if pending:
+				stat_key = key
+				paths = files.paths
+				pending = 0 if self.settings.sort_reverse else 1
+				def key(record):
+					if files.has_stat(record):
+						return (1 - pending, stat_key(record))
+					return (pending, paths[record].lower())
+			return array('L', sorted(files.order, key=key))
+
+		if pending:
+			stat_sort_func = sort_func
+			pending = 0 if self.settings.sort_reverse else 1
+			def sort_func(item):
+				if item._dir_entry is None:
+					return (1 - pending, stat_sort_func(item))
+				return (pending, item.basename_lower)
+		return sorted(files, key=sort_func)
+
+	def _get_record_sort_func(self, files):
+		"""
+		Returns a key function for the records of a FileList, or None if
+		the current sort key needs the objects.
+		"""
+		sort = self.settings.sort
+		case_insensitive = self.settings.sort_case_insensitive
+		paths = files.paths
+		start = files.prefix_length
+		if sort == 'basename':
+			if case_insensitive:
+				return lambda record: paths[record].lower()
+			return paths.__getitem__
+		elif sort == 'natural':
+			if case_insensitive:
+				return lambda record: natural_key(paths[record][start:].lower())
+			return lambda record: natural_key(paths[record][start:])
+		elif sort == 'size':
+			sizes = files.sizes
+			return lambda record: -(files.item(record).size
+					if files.is_dir(record) else sizes[record])
+		elif sort == 'mtime':
+			mtimes = files.mtimes
+			return lambda record: -(mtimes[record] or 1)
+		elif sort == 'ctime':
+			ctimes = files.ctimes
+			return lambda record: -(ctimes[record] or 1)
+		elif sort == 'atime':
+			atimes = files.atimes
+			return lambda record: -(atimes[record] or 1)
+		elif sort == 'type':
+			return self._get_record_mimetype_func(files)
+		return None
+
+	def _get_record_mimetype_func(self, files):
+		"""
+		Returns a function which guesses the mimetype of a record from its
+		name, like FileSystemObject.set_mimetype(), or '' if it's unknown
+		"""
+		guess_type = self.fm.mimetypes.guess_type
+		paths = files.paths
+		start = files.prefix_length
+		def mimetype(record):
+			name = paths[record][start:]
+			if name.lower().endswith('.part'):
+				name = name[:-5]
+			return guess_type(name, False)[0] or ''
+		return mimetype
+
+	def _insort(self, files, item):
+		"""Insert <item> into <files>, which is sorted like sort() does"""
+		sort_func = self._get_sort_func()
+		reverse = self.settings.sort_reverse
+		dirs_first = self.settings.sort_directories_first
+		key = sort_func(item)
+		dir_key = sort_by_directory(item)
+
+		low, high = 0, len(files)
+		while low < high:
+			middle = (low + high) // 2
+			other = files[middle]
+			other_dir_key = sort_by_directory(other)
+			if dirs_first and dir_key != other_dir_key:
+				before = dir_key < other_dir_key
+			elif reverse:
+				before = sort_func(other) < key
+			else:
+				before = key < sort_func(other)
+			if before:
+				high = middle
+			else:
+				low = middle + 1
+		files.insert(low, item)
 
-	def look_up_cumulative_size(self):
+	def look_up_cumulative_size(self, fresh=False):
+		"""
+		Calculate the size of the directory tree in the background.  If
+		<fresh> is true, the sizes which are remembered for unchanged
+		directories are not used, since the files in them may have grown.
+		"""
+		if self.cumulative_size_loader is not None:
+			self.fm.loader.remove(self.cumulative_size_loader)
+		loadable = CumulativeSizeLoader(self, fresh)
+		self.cumulative_size_loader = loadable
+		self.fm.loader.add(loadable)
+
+	def _set_cumulative_size(self, loadable, size):
+		"""Called on the main thread when the CumulativeSizeLoader is done"""
+		if self.cumulative_size_loader is loadable:
+			self.cumulative_size_loader = None
 		self._cumulative_size_calculated = True
-		self.size = self._get_cumulative_size()
+		self.size = size
 		self.infostring = ('-> ' if self.is_link else ' ') + \
 				human_readable(self.size)
+		try:
+			self.fm.ui.status.request_redraw()
+			self.fm.ui.redraw_main_column()
+		except AttributeError:
+			pass
 
-	@lazy_property
-	def size(self):
+	@property
+	def disk_usage(self):
+		"""The summed up size of the containing files"""
+		if self._disk_usage is not None:
+			return self._disk_usage
+		if not self.files:
+			return 0
+		if isinstance(self.files, FileList):
+			if self.background_stat is not None \
+					or not self.files.has_all_stats():
+				return self.files.disk_usage()
+			self._disk_usage = self.files.disk_usage()
+			return self._disk_usage
+		if self.background_stat is not None:
+			# Don't stat the remaining files now, count the known ones
+			return sum(item.size for item in self.files
+					if item.is_file and item._dir_entry is None)
+		self._disk_usage = sum(item.size for item in self.files
+				if item.is_file)
+		return self._disk_usage
+
+	def _get_entry_counter(self):
 		try:
-			size = len(os.listdir(self.path))  # bite me
-		except OSError:
+			return self.fm.entry_counter
+		except AttributeError:
+			return None
+
+	def load_entry_count(self):
+		"""Find out the number of entries for the infostring"""
+		counter = self._get_entry_counter()
+		if counter is None:
+			try:
+				size = len(os.listdir(self.path))  # bite me
+			except OSError:
+				size = None
+		else:
+			size = counter.count(self)
+		if size is None:
 			self.infostring = BAD_INFO
 			self.accessible = False
 			self.runnable = False
-			return 0
+			self.size = 0
 		else:
 			self.infostring = ' %d' % size
 			self.accessible = True
 			self.runnable = True
-			return size
+			self.size = size
+		if self.is_link:
+			self.infostring = '->' + self.infostring
+		return self.size
+
+	def forget_entry_count_request(self):
+		"""Request the count again when the infostring is needed next time"""
+		if 'size' not in self.__dict__:
+			try:
+				del self.infostring
+			except AttributeError:
+				pass
+
+	@lazy_property
+	def size(self):
+		return self.load_entry_count()
 
 	@lazy_property
 	def infostring(self):
-		self.size  # trigger the lazy property initializer
-		if self.is_link:
-			return '->' + self.infostring
-		return self.infostring
+		if 'size' in self.__dict__:
+			infostring = ' %d' % self.size
+			if self.is_link:
+				return '->' + infostring
+			return infostring
+		counter = self._get_entry_counter()
+		if counter is not None and counter.get(self) is None:
+			# Leave it empty until the entries are counted in the background
+			counter.request(self)
+			return ''
+		self.load_entry_count()
+		return self.__dict__['infostring']
 
 	@lazy_property
 	def runnable(self):
@@ -403,6 +1233,14 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 		if self.empty():
 			return
 
+		if isinstance(self.files, FileList):
+			try:
+				index = self.files.index_path(arg)
+			except ValueError:
+				return self.move(to=self.pointer)
+			self.move(to=index)
+			return True
+
 		Accumulator.move_to_obj(self, arg, attr='path')
 
 	def search_fnc(self, fnc, offset=1, forward=True):
@@ -427,17 +1265,121 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 				return True
 		return False
 
+	def search(self, query, offset=1, forward=True):
+		"""
+		Like search_fnc, but finds the files which contain <query>, a
+		string, or in which <query>, a compiled regexp, finds a match,
+		with a SearchIndex of the basenames.
+		"""
+		if not self.files:
+			return False
+		length = len(self.files)
+		if forward:
+			start = self.pointer + offset - 1
+		else:
+			start = self.pointer - offset + 1
+		index = self._get_search_index().next_match(query,
+				start % length, forward)
+		if index is None:
+			return False
+		self.pointer = index
+		self.pointed_obj = self.files[index]
+		self.correct_pointer()
+		return True
+
+	def get_names(self):
+		"""
+		Returns the basenames of the listed files in their order, without
+		creating the FileSystemObjects of a FileList
+		"""
+		files = self.files
+		if files is None:
+			return []
+		if isinstance(files, FileList):
+			start = files.prefix_length
+			paths = files.paths
+			return [paths[record][start:] for record in files.order]
+		return [item.basename for item in files]
+
+	def get_link_names(self):
+		"""Returns the set of basenames of the listed symlinks"""
+		files = self.files
+		if files is None:
+			return set()
+		if isinstance(files, FileList):
+			return set(files.basename(record) for record in files.order
+					if files.flags[record] & IS_LINK)
+		return set(item.basename for item in files if item.is_link)
+
+	def _get_search_index(self):
+		if self._search_index is None:
+			self._search_index = SearchIndex(self.get_names())
+		return self._search_index
+
+	def get_ordering(self, order):
+		"""
+		Returns the paths of the files sorted by a key of cycle_dict.  The
+		result is remembered until the files or their stats change.
+		"""
+		if self._orderings is None:
+			self._orderings = {}
+		try:
+			return self._orderings[order]
+		except KeyError:
+			pass
+		files = self.files
+		complete = self.background_stat is None
+		if isinstance(files, FileList):
+			if order in self.stat_sorts and not files.has_all_stats():
+				# Until the records are stat'ed, the order is a guess
+				self.stat_remaining_files()
+				complete = False
+			key = self._get_record_cycle_func(files, order)
+			paths = files.paths
+			ordering = [paths[record] for record in sorted(files.order, key=key)]
+		else:
+			ordering = [item.path for item in
+					sorted(files, key=self.cycle_dict[order])]
+		# Stats that arrive later would change the order
+		if complete:
+			self._orderings[order] = ordering
+		return ordering
+
+	def _get_record_cycle_func(self, files, order):
+		"""Like cycle_dict, but for the records of a FileList"""
+		item_key = self.cycle_dict[order]
+		if order == 'size':
+			sizes = files.sizes
+			is_dir = files.is_dir
+			# The size of a directory is its number of entries
+			return lambda record: item_key(files.item(record)) \
+					if is_dir(record) else -sizes[record]
+		elif order == 'mtime':
+			mtimes = files.mtimes
+			return lambda record: -int(mtimes[record])
+		elif order == 'ctime':
+			ctimes = files.ctimes
+			return lambda record: -int(ctimes[record])
+		elif order == 'atime':
+			atimes = files.atimes
+			return lambda record: -int(atimes[record])
+		elif order == 'mimetype':
+			return self._get_record_mimetype_func(files)
+		return lambda record: item_key(files.item(record))
+
 	def set_cycle_list(self, lst):
-		self.cycle_list = deque(lst)
+		self.cycle_list = lst
+		self._cycle_position = 0
 
 	def cycle(self, forward=True):
 		if self.cycle_list:
 			if forward is True:
-				self.cycle_list.rotate(-1)
+				self._cycle_position += 1
 			elif forward is False:
-				self.cycle_list.rotate(1)
+				self._cycle_position -= 1
+			self._cycle_position %= len(self.cycle_list)
 
-			self.move_to_obj(self.cycle_list[0])
+			self.move_to_obj(self.cycle_list[self._cycle_position])
 
 	def correct_pointer(self):
 		"""Make sure the pointer is in the valid range"""
@@ -468,6 +1410,9 @@ class Directory(FileSystemObject, Accumulator, Loadable, SettingsAware):
 			self.load_content(*a, **k)
 			return True
 
+		if self.watched:
+			return False
+
 		try:
 			real_mtime = os.stat(self.path).st_mtime
 		except OSError:
@@ -0,0 +1,273 @@
+# Copyright (C) 2012  Roman Zimbelmann <romanz@lavabit.com>
+# This software is distributed under the terms of the GNU GPL version 3.
+
+"""
+A compact representation of the files in huge directories.
+
+A FileList stores the path, type, inode and, once they are known, the
+other stat fields of each file in plain lists and arrays.
+FileSystemObjects are only created when an item is accessed, for example
+to draw it, and they are discarded again once they are not used anymore.  Items which are marked, pointed at or copied stay
+alive as usual since something refers to them.
+
+Besides indexing, slicing, iterating and len(), a FileList supports the
+parts of the list API that ranger uses, where items are compared by their
+path.  The order of the items is a permutation of the records, so sorting
+never moves the data itself.
+"""
+
+from array import array
+from collections import deque
+from os import stat_result
+from weakref import WeakValueDictionary
+
+from ranger.container.listingcache import CachedEntry, HAS_STAT, IS_DIR, \
+		IS_LINK
+
+# How many of the recently created objects are kept alive, so redrawing
+# the visible files doesn't create them again each time
+RECENT_ITEMS = 256
+
+# Inode and device numbers take 64 bits, which array('L') only has on some
+# platforms, and array('Q') isn't there before python 3.3
+try:
+	array('Q')
+except ValueError:
+	_integers = list
+else:
+	_integers = lambda: array('Q')
+
+class FileList(object):
+	def __init__(self, path, make_item):
+		"""
+		<make_item> is called with the path, flags, mode, inode and stat
+		(or None) of a record and returns a FileSystemObject for it.
+		"""
+		self.prefix_length = len(path) + (path != '/')
+		self.paths = []
+		self.flags = array('B')
+		self.modes = array('L')
+		self.inodes = _integers()
+		self.devs = _integers()
+		self.nlinks = array('L')
+		self.uids = array('L')
+		self.gids = array('L')
+		self.sizes = array('d')
+		self.atimes = array('d')
+		self.mtimes = array('d')
+		self.ctimes = array('d')
+		self.order = array('L')
+		self.stat_count = 0  # how many records have HAS_STAT
+		self._make_item = make_item
+		self._objects = WeakValueDictionary()
+		self._recent = deque(maxlen=RECENT_ITEMS)
+		self._records = None  # path -> record, built by index_path()
+		self._positions = None  # (order, position of each record)
+
+	def append_entry(self, path, entry):
+		"""
+		Add a record for the os.DirEntry-like object <entry>.  The stat of a
+		CachedEntry from the listing cache is stored right away, so a
+		directory rebuilt from the cache needn't stat its files again.
+
+		>>> import os, shutil, tempfile
+		>>> from ranger.container.listingcache import ListingCache
+		>>> tmp = tempfile.mkdtemp()
+		>>> os.mkdir(os.path.join(tmp, 'dir'))
+		>>> path = os.path.join(tmp, 'dir', 'file')
+		>>> open(path, 'w').write('content') and None
+		>>> cache = ListingCache(os.path.join(tmp, 'cache'), 2 ** 20)
+		>>> stat = os.lstat(path)
+		>>> for _ in cache.store(os.path.join(tmp, 'dir'), '', 1,
+		...         [('file', 0, stat.st_mode, stat.st_ino, stat)]):
+		...     pass
+		>>> count, entries = cache.get(os.path.join(tmp, 'dir'), '')
+		>>> files = FileList(os.path.join(tmp, 'dir'), None)
+		>>> files.append_entry(path, entries[0])
+		>>> files.has_all_stats(), files.stat(0).st_size
+		(True, 7)
+		>>> shutil.rmtree(tmp)
+		"""
+		try:
+			if entry.is_symlink():
+				flags = IS_LINK
+				mode = 0o120000
+			elif entry.is_dir(follow_symlinks=False):
+				flags = 0
+				mode = 0o040000
+			elif entry.is_file(follow_symlinks=False):
+				flags = 0
+				mode = 0o100000
+			else:
+				flags = 0
+				mode = 0
+			if entry.is_dir():
+				flags |= IS_DIR
+		except OSError:
+			flags = 0
+			mode = 0
+		try:
+			inode = entry.inode()
+		except OSError:
+			inode = 0
+		self._records = None
+		self._positions = None
+		self.order.append(len(self.paths))
+		self.paths.append(path)
+		self.flags.append(flags)
+		self.modes.append(mode)
+		self.inodes.append(inode)
+		for fields in (self.devs, self.nlinks, self.uids, self.gids,
+				self.sizes, self.atimes, self.mtimes, self.ctimes):
+			fields.append(0)
+		if isinstance(entry, CachedEntry) and entry._stat is not None:
+			self.set_stat(len(self.paths) - 1, entry._stat)
+
+	def set_stat(self, record, stat):
+		"""Store the fields of <stat> in the record"""
+		if stat is not None:
+			self.modes[record] = stat.st_mode
+			self.devs[record] = stat.st_dev
+			self.nlinks[record] = stat.st_nlink
+			self.uids[record] = stat.st_uid
+			self.gids[record] = stat.st_gid
+			self.sizes[record] = stat.st_size
+			self.atimes[record] = stat.st_atime
+			self.mtimes[record] = stat.st_mtime
+			self.ctimes[record] = stat.st_ctime
+		if not self.flags[record] & HAS_STAT:
+			self.flags[record] |= HAS_STAT
+			self.stat_count += 1
+
+	def stat(self, record):
+		"""
+		Returns the stored stat of the record, or None if it wasn't stat'ed
+		or is a symlink, whose record holds the stat of the target.
+		"""
+		flags = self.flags[record]
+		if not flags & HAS_STAT or flags & IS_LINK:
+			return None
+		return stat_result((self.modes[record], self.inodes[record],
+				self.devs[record], self.nlinks[record], self.uids[record],
+				self.gids[record], int(self.sizes[record]), self.atimes[record],
+				self.mtimes[record], self.ctimes[record]))
+
+	def has_all_stats(self):
+		"""Whether every record was stat'ed"""
+		return self.stat_count == len(self.paths)
+
+	def copy(self):
+		"""
+		Returns a FileList with copies of the records, but neither the
+		order nor the FileSystemObjects, which a thread can read while
+		this one changes
+		"""
+		other = FileList('', None)
+		other.prefix_length = self.prefix_length
+		other.paths = list(self.paths)
+		for name in ('flags', 'modes', 'inodes', 'devs', 'nlinks', 'uids',
+				'gids', 'sizes', 'atimes', 'mtimes', 'ctimes'):
+			setattr(other, name, getattr(self, name)[:])
+		other.order = array('L', range(len(other.paths)))
+		other.stat_count = self.stat_count
+		return other
+
+	def basename(self, record):
+		return self.paths[record][self.prefix_length:]
+
+	def is_dir(self, record):
+		return bool(self.flags[record] & IS_DIR)
+
+	def has_stat(self, record):
+		return bool(self.flags[record] & HAS_STAT)
+
+	def item(self, record):
+		"""Returns the FileSystemObject for the record"""
+		obj = self._objects.get(record)
+		if obj is None:
+			obj = self._make_item(self.paths[record], self.flags[record],
+					self.modes[record], self.inodes[record], self.stat(record))
+			self._objects[record] = obj
+			self._recent.append(obj)
+		return obj
+
+	def count_items(self):
+		"""Returns how many objects for the files exist at the moment"""
+		return len(self._objects)
+
+	def disk_usage(self):
+		"""The summed up size of the listed files which were stat'ed"""
+		flags = self.flags
+		sizes = self.sizes
+		return int(sum(sizes[record] for record in self.order
+				if flags[record] & HAS_STAT and not flags[record] & IS_DIR))
+
+	def __len__(self):
+		return len(self.order)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self.item(self.order[i])
+					for i in range(*index.indices(len(self.order)))]
+		return self.item(self.order[index])
+
+	def __iter__(self):
+		for record in self.order:
+			yield self.item(record)
+
+	def __contains__(self, obj):
+		try:
+			self.index(obj)
+		except (ValueError, AttributeError):
+			return False
+		return True
+
+	def index(self, obj):
+		"""Returns the position of the item with the same path as <obj>"""
+		return self.index_path(obj.path)
+
+	def index_path(self, path):
+		"""
+		Returns the position of the item with this path.  Raises a
+		ValueError if there is no such item, or if it isn't in the order.
+		"""
+		if self._records is None:
+			self._records = dict((name, record)
+					for record, name in enumerate(self.paths))
+		try:
+			record = self._records[path]
+		except KeyError:
+			raise ValueError(path)
+		order = self.order
+		if self._positions is None or self._positions[0] is not order:
+			positions = array('l', [-1]) * len(self.paths)
+			for position, other in enumerate(order):
+				positions[other] = position
+			self._positions = (order, positions)
+		position = self._positions[1][record]
+		if position < 0:
+			raise ValueError(path)
+		return position
+
+	def sort(self, key=None, reverse=False):
+		"""Sort by a key function of the FileSystemObjects, like list.sort"""
+		if key is None:
+			item_key = self.item
+		else:
+			item_key = lambda record: key(self.item(record))
+		self.sort_records(item_key, reverse)
+
+	def sort_records(self, key, reverse=False):
+		"""Sort by a key function of the records"""
+		self.order = array('L', sorted(self.order, key=key, reverse=reverse))
+
+	def reverse(self):
+		self.order.reverse()
+		self._positions = None
+
+	def __repr__(self):
+		return "<FileList of {0} files>".format(len(self.order))
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
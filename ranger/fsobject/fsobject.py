@@ -25,15 +25,39 @@ _extract_number_re = re.compile(r'([^0-9]?)(\d*)')
 def safe_path(path):
 	return path.translate(_safe_string_table)
 
+def natural_key(string):
+	"""
+	Returns a key for sorting strings with numbers in their natural order
+
+	>>> sorted(['a10', 'a9', 'b1'], key=natural_key)
+	['a9', 'a10', 'b1']
+	"""
+	return [c if i % 3 == 1 else (int(c) if c else 0) for i, c in \
+		enumerate(_extract_number_re.split(string))]
+
+class _stat_property(object):
+	"""
+	A class attribute with a default value which performs the pending
+	stat of FileSystemObjects that were loaded from a DirEntry.
+	"""
+
+	def __init__(self, name, default):
+		self.__name__ = name
+		self.default = default
+
+	def __get__(self, obj, cls=None):
+		if obj is None or obj._dir_entry is None:
+			return self.default
+		obj.load_stat()
+		return getattr(obj, self.__name__)
+
 class FileSystemObject(FileManagerAware):
 	(basename,
 	basename_lower,
 	dirname,
 	extension,
-	infostring,
 	path,
-	permissions,
-	stat) = (None,) * 8
+	permissions) = (None,) * 6
 
 	(content_loaded,
 	force_load,
@@ -45,8 +69,6 @@ class FileSystemObject(FileManagerAware):
 	is_link,
 	is_socket,
 
-	accessible,
-	exists,       # "exists" currently means "link_target_exists"
 	loaded,
 	marked,
 	runnable,
@@ -58,9 +80,20 @@ class FileSystemObject(FileManagerAware):
 	document,
 	image,
 	media,
-	video) = (False,) * 21
+	video) = (False,) * 19
+
+	# These are filled in by load() or, if the object was loaded from a
+	# DirEntry, by load_stat() once one of them is accessed.
+	stat = _stat_property('stat', None)
+	infostring = _stat_property('infostring', None)
+	accessible = _stat_property('accessible', False)
+	exists = _stat_property('exists', False)  # means "link_target_exists"
+	size = _stat_property('size', 0)
 
-	size = 0
+	# The attributes that load_stat() is responsible for
+	lazy_stat_attributes = ('stat', 'infostring', 'accessible', 'exists',
+			'size')
+	_dir_entry = None
 
 
 	def __init__(self, path, preload=None, path_is_abs=False):
@@ -95,13 +128,11 @@ class FileSystemObject(FileManagerAware):
 
 	@lazy_property
 	def basename_natural(self):
-		return [c if i % 3 == 1 else (int(c) if c else 0) for i, c in \
-			enumerate(_extract_number_re.split(self.basename))]
+		return natural_key(self.basename)
 
 	@lazy_property
 	def basename_natural_lower(self):
-		return [c if i % 3 == 1 else (int(c) if c else 0) for i, c in \
-			enumerate(_extract_number_re.split(self.basename_lower))]
+		return natural_key(self.basename_lower)
 
 	@lazy_property
 	def safe_basename(self):
@@ -119,7 +150,7 @@ class FileSystemObject(FileManagerAware):
 	def use(self):
 		"""Used in garbage-collecting.  Override in Directory"""
 
-	def look_up_cumulative_size(self):
+	def look_up_cumulative_size(self, fresh=False):
 		pass # normal files have no cumulative size
 
 	def set_mimetype(self):
@@ -185,12 +216,18 @@ class FileSystemObject(FileManagerAware):
 
 		self.fm.update_preview(self.path)
 		self.loaded = True
+		self._dir_entry = None
 
 		# Get the stat object, either from preload or from [l]stat
 		self.permissions = None
 		new_stat = None
 		path = self.path
 		is_link = False
+		if self.preload and not isinstance(self.preload, tuple):
+			entry = self.preload
+			self.preload = None
+			if self._defer_stat(entry):
+				return
 		if self.preload:
 			new_stat = self.preload[1]
 			is_link = new_stat.st_mode & 0o170000 == 0o120000
@@ -208,8 +245,40 @@ class FileSystemObject(FileManagerAware):
 			except:
 				self.exists = False
 
-		# Set some attributes
+		self._set_stat(new_stat, is_link)
 
+	def _defer_stat(self, entry):
+		"""
+		Take what is known from the DirEntry <entry> without a syscall and
+		postpone the stat until it is needed.  Returns False if the entry
+		is a symlink or a special file, which need to be stat'ed anyway.
+		"""
+		try:
+			if entry.is_symlink() or not (entry.is_dir(follow_symlinks=False)
+					or entry.is_file(follow_symlinks=False)):
+				return False
+		except OSError:
+			return False
+		for attr in self.lazy_stat_attributes:
+			self.__dict__.pop(attr, None)
+		self._dir_entry = entry
+		return True
+
+	def load_stat(self):
+		"""Perform the stat that was deferred when loading from a DirEntry"""
+		entry = self._dir_entry
+		if entry is None:
+			return
+		self._dir_entry = None
+		try:
+			new_stat = entry.stat(follow_symlinks=False)
+		except OSError:
+			new_stat = None
+		self.exists = new_stat is not None
+		self._set_stat(new_stat, False)
+
+	def _set_stat(self, new_stat, is_link):
+		"""Set the attributes which are derived from the stat object"""
 		self.accessible = True if new_stat else False
 		mode = new_stat.st_mode if new_stat else 0
 
@@ -280,3 +349,7 @@ class FileSystemObject(FileManagerAware):
 			self.load()
 			return True
 		return False
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -168,6 +168,7 @@ class UI(DisplayableContainer):
 			self.handle_key(key)
 
 	def handle_input(self):
+		"""Read and handle a key press, returns whether there was one"""
 		key = self.win.getch()
 		if key is 27 or key >= 128 and key < 256:
 			# Handle special keys like ALT+X or unicode here:
@@ -204,6 +205,7 @@ class UI(DisplayableContainer):
 				else:
 					if not self.fm.input_is_blocked():
 						self.handle_key(key)
+		return key != -1
 
 	def setup(self):
 		"""Build up the UI by initializing widgets."""
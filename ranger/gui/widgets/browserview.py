@@ -90,6 +90,15 @@ class BrowserView(Widget, DisplayableContainer):
 			self.win.erase()
 			self.need_redraw = True
 			self.need_clear = False
+		visible = set()
+		for path in self.fm.tabs.values():
+			if path is not None:
+				visible.add(self.env.get_directory(path))
+		for column in self.columns:
+			if column.target and column.target.is_directory:
+				visible.add(column.target)
+		if self.fm.watcher:
+			self.fm.watcher.update(visible)
 		for path in self.fm.tabs.values():
 			if path is not None:
 				directory = self.env.get_directory(path)
@@ -5,6 +5,7 @@
 The TaskView allows you to modify what the loader is doing.
 """
 
+import ranger
 from . import Widget
 from ranger.ext.accumulator import Accumulator
 
@@ -21,7 +22,8 @@ class TaskView(Widget, Accumulator):
 		base_clr.append('in_taskview')
 		lst = self.get_list()
 
-		if self.old_lst != lst:
+		# The descriptions of running tasks may show their progress
+		if self.old_lst != lst or lst or ranger.arg.debug:
 			self.old_lst = lst
 			self.need_redraw = True
 
@@ -33,7 +35,10 @@ class TaskView(Widget, Accumulator):
 			if self.hei <= 0:
 				return
 
-			self.addstr(0, 0, "Task View")
+			title = "Task View"
+			if ranger.arg.debug:
+				title += " - loader: " + self.fm.loader.get_budget_stat()
+			self.addstr(0, 0, title)
 			self.color_at(0, 0, self.wid, tuple(base_clr), 'title')
 
 			if lst: